@@ -0,0 +1,160 @@
+""" asyncio entry points for finding choruses from within an event loop (python 3.7+ only) """
+from decoders import FfmpegDecoder
+from file_utils import DecodeError, FileUtils
+from instrumentation import Instrumentation
+from models import Song
+import numpy as np
+import subprocess
+import tempfile
+import asyncio
+
+
+class _BufferReader(object):
+    """ a file like view of the start of a bytearray, enough for FileUtils._read_stream_header """
+
+    def __init__(self, buf):
+        self.buf = buf
+        self.position = 0
+
+    def read(self, num_bytes):
+        data = bytes(self.buf[self.position:self.position + num_bytes])
+        self.position += len(data)
+        return data
+
+
+class AsyncChorusFinder(object):
+    """ finds choruses without blocking the event loop. Files an in process decoder can read (see decoders) are
+    decoded and analysed on an executor, anything else is decoded by an asyncio ffmpeg subprocess whose PCM output is
+    read as it's produced before the (numpy) analysis runs on the executor. At most max_concurrency
+    files are decoded / analysed at once, the rest wait their turn. Cancelling a call kills its ffmpeg process, though
+    an analysis already running on the executor is left to finish in the background
+    """
+    # the default number of files handled at once
+    MAX_CONCURRENCY = 4
+
+    def __init__(self, executor=None, max_concurrency=MAX_CONCURRENCY, method=Song.AMPLITUDE):
+        """
+        :param executor: ``concurrent.futures.Executor`` the analysis runs on (defaults to the loop's default executor)
+        :param max_concurrency: ``int`` the maximum number of files decoded / analysed at once
+        :param method: the strategy Song.find_chorus should use
+        """
+        self.executor = executor
+        self.max_concurrency = max_concurrency
+        self.method = method
+
+        # a semaphore belongs to the loop it's first used on, so one is kept per loop
+        self._semaphores = {}
+
+    @property
+    def _semaphore(self):
+        loop = asyncio.get_running_loop()
+        if loop not in self._semaphores:
+            self._semaphores = dict((other, semaphore) for other, semaphore in self._semaphores.items()
+                                    if not other.is_closed())
+            self._semaphores[loop] = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphores[loop]
+
+    #####-----< Helpers >-----#####
+    @staticmethod
+    def _analyse(samples, sample_rate, method, path=None):
+        """ find the chorus of decoded samples (run on the executor)
+        :return: two-tuple of the start and end (in seconds) of the chorus, or (None, None)
+        """
+        with Instrumentation.track(path):
+            song = Song(samples=samples, sample_rate=sample_rate)
+            chorus_start, chorus_end = song.find_chorus(method=method)
+
+        return song.chorus_times(chorus_start, chorus_end)
+
+    @staticmethod
+    def _decode_in_process(path, decoders, method):
+        """ decode and analyse a file with the given in process decoders (run on the executor) """
+        with Instrumentation.track(path):
+            sample_rate, samples = FileUtils(path).get_file_data(decoders=decoders)
+        return AsyncChorusFinder._analyse(samples, sample_rate, method, path=path)
+
+    async def _decode(self, path):
+        """ decode path with an ffmpeg subprocess, collecting its PCM output as it arrives
+        :return: two-tuple of the sample rate and an ``array`` of int16 samples
+        """
+        errors = tempfile.TemporaryFile()
+        try:
+            process = await asyncio.create_subprocess_exec(
+                "ffmpeg", "-nostdin", "-v", "error", "-i", path, "-vn", "-ac", "1", "-acodec", "pcm_s16le", "-f", "wav",
+                "-", stdout=subprocess.PIPE, stderr=errors)
+        except OSError as e:
+            errors.close()
+            raise DecodeError("unable to run ffmpeg: {}".format(e))
+
+        buf = bytearray()
+        try:
+            with Instrumentation.stage(Instrumentation.DECODE) as stage:
+                while True:
+                    data = await process.stdout.read(FileUtils.CHUNK_SIZE)
+                    if not data:
+                        break
+                    buf.extend(data)
+                return_code = await process.wait()
+
+                if return_code != 0:
+                    errors.seek(0)
+                    raise DecodeError("ffmpeg failed to decode {path} (exit code {code}): {message}".format(
+                        path=path, code=return_code, message=errors.read().decode("utf-8", "replace").strip()))
+
+                reader = _BufferReader(buf)
+                sample_rate, _ = FileUtils._read_stream_header(reader)
+                samples = np.frombuffer(buf, dtype="<i2", offset=reader.position,
+                                        count=(len(buf) - reader.position) // 2)
+                stage.samples = len(samples)
+        finally:
+            # a cancelled (or failed) decode mustn't leave ffmpeg running
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            errors.close()
+
+        if len(samples) == 0:
+            raise DecodeError("ffmpeg decoded no audio from {}".format(path))
+        return sample_rate, samples
+
+    #####-----< Public >-----#####
+    async def find_chorus(self, path, method=None):
+        """
+        :param path: ``str`` path to the song
+        :param method: the strategy Song.find_chorus should use (defaults to the finder's)
+        :return: two-tuple of the start and end (in seconds) of the chorus, or (None, None)
+        """
+        method = method or self.method
+        loop = asyncio.get_running_loop()
+
+        async with self._semaphore:
+            decoders = FileUtils(path).decoders()
+            in_process = [decoder for decoder in decoders if decoder is not FfmpegDecoder]
+            if in_process:
+                try:
+                    return await loop.run_in_executor(self.executor, self._decode_in_process, path, in_process, method)
+                except DecodeError:
+                    # ffmpeg is run here rather than on the executor, so it can be killed if the call is cancelled
+                    if FfmpegDecoder not in decoders:
+                        raise
+
+            sample_rate, samples = await self._decode(path)
+            return await loop.run_in_executor(self.executor, self._analyse, samples, sample_rate, method, path)
+
+    async def find_choruses(self, paths, method=None):
+        """ find the chorus of every path at once (subject to the concurrency limit)
+        :return: ``list`` of two-tuples of the start and end (in seconds) of each chorus, in the order of paths
+        """
+        return await asyncio.gather(*[self.find_chorus(path, method=method) for path in paths])
+
+
+# the finder used by find_chorus_async, so concurrent calls share its concurrency limit
+_default_finder = AsyncChorusFinder()
+
+
+async def find_chorus_async(path, method=Song.AMPLITUDE, finder=None):
+    """ find the chorus of the file at path without blocking the event loop
+    :param finder: ``AsyncChorusFinder`` to use, defaults to one shared by every call (see MAX_CONCURRENCY)
+    :return: two-tuple of the start and end (in seconds) of the chorus, or (None, None)
+    """
+    return await (finder or _default_finder).find_chorus(path, method=method)
@@ -0,0 +1,230 @@
+from file_utils import FileType, FileUtils
+from instrumentation import Instrumentation, Profiler
+from models import Song
+from sound_utils import Parallel
+import multiprocessing
+import traceback
+import resource
+import glob
+import json
+import time
+import os
+import sys
+
+def collect_paths(source):
+    """ expand a batch source into the list of files it refers to
+    :param source: ``str`` either a directory (searched recursively for supported files), a glob pattern or a manifest
+    file listing one path per line (blank lines and lines starting with # are ignored)
+    :return: ``list`` of ``str`` paths
+    """
+    extensions = FileType.ALL
+
+    if os.path.isdir(source):
+        paths = []
+        for directory, _, files in os.walk(source):
+            paths += [os.path.join(directory, f) for f in sorted(files) if f.lower().endswith(extensions)]
+        return sorted(paths)
+
+    if os.path.isfile(source) and not source.lower().endswith(extensions):
+        with open(source) as manifest:
+            lines = [line.strip() for line in manifest]
+        return [line for line in lines if line and not line.startswith("#")]
+
+    return sorted(glob.glob(source))
+
+
+def analyse(path, method=Song.AMPLITUDE, profile=False, analysis_rate=None, decoder=None, cascade=False):
+    """ find the chorus of a single file
+    :param profile: ``bool`` whether to include the breakdown of the file's stages (see Profiler.breakdown)
+    :param analysis_rate: ``int`` the sampling rate the file is analysed at (see FileUtils)
+    :param decoder: ``str`` the name of the decoder the file is read with (see FileUtils)
+    :param cascade: ``bool`` whether to only analyse the spectrum of the regions which could hold the chorus (see
+    Song.cascade), in which case the result includes the fraction of the file which was skipped
+    :return: ``dict`` with the chorus start and end (in seconds), the method which found it, stage timings (in seconds)
+    and the error which stopped the analysis, if any
+    """
+    if profile:
+        with Profiler() as profiler, Instrumentation.track(path):
+            result = analyse(path, method=method, analysis_rate=analysis_rate, decoder=decoder, cascade=cascade)
+        result["stages"] = profiler.breakdown().get(path, {})
+        return result
+
+    result = {"path": path, "start": None, "end": None, "method": None, "timings": {}, "error": None}
+    started = time.time()
+
+    try:
+        rate, data = FileUtils(path, analysis_rate=analysis_rate, decoder=decoder).get_file_data()
+        result["timings"]["decode"] = time.time() - started
+
+        analysis_started = time.time()
+        song = Song(samples=data, sample_rate=rate, cascade=cascade)
+        if cascade:
+            result["skipped"] = song.table.skipped_fraction
+        chorus_start, chorus_end = song.find_chorus(method=method)
+        result["timings"]["analysis"] = time.time() - analysis_started
+
+        if chorus_start:
+            result["start"], result["end"] = song.chorus_times(chorus_start, chorus_end)
+            result["method"] = song.chorus_method
+    except MemoryError:
+        result["error"] = "MemoryError: memory limit exceeded"
+    except Exception as e:
+        result["error"] = "{name}: {message}".format(name=type(e).__name__, message=e)
+        result["traceback"] = traceback.format_exc()
+
+    result["timings"]["total"] = time.time() - started
+    return result
+
+
+def _work(tasks, results, memory_limit, analyser, kwargs):
+    """ the body of a worker process: analyse each path sent on tasks until None is received, sending each result
+    down the worker's own results pipe
+    """
+    if memory_limit:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+    # the files are already spread across the cores by the workers, so each file is analysed on a single thread
+    Parallel.WORKERS = 1
+
+    for task_id, path in iter(tasks.get, None):
+        results.send((task_id, analyser(path, **kwargs)))
+
+
+class BatchRunner(object):
+    """ analyses many files on a pool of worker processes. Each worker has its own task queue and results pipe so that a
+    worker which runs over its time limit (or dies) can be killed and replaced - even part way through sending a
+    result - without losing track of the file it was working on or corrupting the results of the other workers
+    """
+    # how often (in seconds) the runner checks on its workers while waiting for results
+    POLL_INTERVAL = .1
+    # the function each worker calls on a path (with the runner's analysis options) to produce its result
+    ANALYSER = staticmethod(analyse)
+
+    def __init__(self, jobs=None, timeout=None, memory_limit=None, method=Song.AMPLITUDE, profile=False,
+                 analysis_rate=None, decoder=None, cascade=False):
+        """
+        :param jobs: ``int`` the number of worker processes (defaults to the number of cores)
+        :param timeout: ``float`` the number of seconds a single file may take before its worker is killed
+        :param memory_limit: ``int`` the maximum address space (in bytes) of each worker
+        :param method: the strategy Song.find_chorus should use
+        :param profile: ``bool`` whether each result should include a breakdown of its stages
+        :param analysis_rate: ``int`` the sampling rate files are analysed at (see FileUtils)
+        :param decoder: ``str`` the name of the decoder files are read with (see FileUtils)
+        :param cascade: ``bool`` whether to only analyse the spectrum of the regions which could hold the chorus
+        """
+        self.jobs = jobs or multiprocessing.cpu_count()
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.method = method
+        self.profile = profile
+        self.analysis_rate = analysis_rate
+        self.decoder = decoder
+        self.cascade = cascade
+
+        self.workers = []
+
+    def _start_worker(self):
+        tasks = multiprocessing.Queue()
+        results, sender = multiprocessing.Pipe(duplex=False)
+        kwargs = dict(method=self.method, profile=self.profile, analysis_rate=self.analysis_rate,
+                      decoder=self.decoder, cascade=self.cascade)
+        process = multiprocessing.Process(target=_work, args=(tasks, sender, self.memory_limit, self.ANALYSER, kwargs))
+        process.daemon = True
+        process.start()
+        # only the worker writes to the pipe, so reading it fails (rather than blocks) once the worker has gone
+        sender.close()
+        # [process, task queue, results pipe, (task id, path, start time) of the current task or None when idle]
+        return [process, tasks, results, None]
+
+    def _replace_worker(self, worker):
+        worker[0].terminate()
+        worker[0].join()
+        worker[2].close()
+        self.workers[self.workers.index(worker)] = self._start_worker()
+
+    def _receive(self):
+        """ collect the results the workers have finished
+        :return: ``list`` of (task id, result ``dict``)
+        """
+        received = []
+        for worker in self.workers:
+            if worker[3] is None or not worker[2].poll():
+                continue
+            try:
+                received.append(worker[2].recv())
+            except (EOFError, IOError, OSError):
+                # the worker died without a result (which is reported when its process is checked)
+                continue
+            worker[3] = None
+
+        return received
+
+    @staticmethod
+    def _failure(path, error, started):
+        return {"path": path, "start": None, "end": None, "method": None,
+                "timings": {"total": time.time() - started}, "error": error}
+
+    def run(self, paths):
+        """ analyse every path, yielding each result as soon as it's finished (so results arrive in completion order,
+        not in the order of paths)
+        :param paths: ``list`` of ``str``
+        :return: generator of result ``dict`` (see ``analyse``)
+        """
+        pending = list(enumerate(paths))[::-1]
+        # the ids of the tasks which haven't produced a result yet (a worker may finish a task just as it's timed out)
+        outstanding = set(task_id for task_id, _ in pending)
+        self.workers = [self._start_worker() for _ in range(min(self.jobs, len(pending)))]
+
+        try:
+            while outstanding:
+                for worker in self.workers:
+                    if worker[3] is None and pending:
+                        task_id, path = pending.pop()
+                        worker[3] = (task_id, path, time.time())
+                        worker[1].put((task_id, path))
+
+                received = self._receive()
+                if not received:
+                    time.sleep(self.POLL_INTERVAL)
+                for task_id, result in received:
+                    outstanding.discard(task_id)
+                    yield result
+
+                for worker in list(self.workers):
+                    if worker[3] is None:
+                        continue
+
+                    task_id, path, started = worker[3]
+                    if not worker[0].is_alive():
+                        error = "worker died (exit code {})".format(worker[0].exitcode)
+                    elif self.timeout and time.time() - started > self.timeout:
+                        error = "timed out after {} seconds".format(self.timeout)
+                    else:
+                        continue
+
+                    self._replace_worker(worker)
+                    outstanding.discard(task_id)
+                    yield self._failure(path, error, started)
+        finally:
+            for process, tasks, _, _ in self.workers:
+                tasks.put(None)
+            for process, _, results, _ in self.workers:
+                process.join(1)
+                if process.is_alive():
+                    process.terminate()
+                results.close()
+
+
+def run_batch(source, output=sys.stdout, **kwargs):
+    """ find the chorus of every file in source, writing one line of JSON per file to output as each one finishes
+    :param source: ``str`` a directory, glob pattern or manifest file (see ``collect_paths``)
+    :param output: file like object the results are written to
+    :param kwargs: passed to ``BatchRunner``
+    :return: ``int`` the number of files which failed
+    """
+    failures = 0
+    for result in BatchRunner(**kwargs).run(collect_paths(source)):
+        failures += result["error"] is not None
+        output.write(json.dumps(result, sort_keys=True) + "\n")
+        output.flush()
+
+    return failures
@@ -0,0 +1,325 @@
+from __future__ import print_function
+from decoders import DECODERS, FileType, available_decoders
+from file_utils import FileUtils
+import decoders
+from instrumentation import Instrumentation
+from sound_utils import SoundUtils
+from models import Song
+import argparse
+import tempfile
+import shutil
+import wave
+import json
+import time
+import sys
+import os
+import numpy as np
+
+
+class SyntheticSong(object):
+    """ a song generated offline from a seed, with verses, choruses and bridges of known position. Verses are quiet
+    and play a different random chord progression each time, choruses are loud, harmonically rich (with noise standing
+    in for drums) and repeat the same progression, and bridges are near silent single notes. The song alternates
+    verses and choruses, and every third chorus is preceded by a bridge instead of a verse
+    """
+    # the lengths (in seconds) of each kind of section and of each chord within it
+    VERSE_SECONDS, CHORUS_SECONDS, BRIDGE_SECONDS = 24, 20, 12
+    CHORD_SECONDS = 4
+    # the peak amplitude (as a fraction of full scale) and number of harmonics of each kind of section
+    VERSE_LEVEL, CHORUS_LEVEL, BRIDGE_LEVEL = .2, .7, .05
+    VERSE_HARMONICS, CHORUS_HARMONICS = 1, 4
+    # the level of the noise (relative to the section's level) mixed into every section
+    NOISE_LEVEL = .05
+    CHORUS_NOISE_LEVEL = .25
+
+    def __init__(self, minutes=3, seed=0, sample_rate=22050):
+        """
+        :param minutes: ``float`` the length of the song
+        :param seed: ``int`` seeds every random choice made generating the song
+        :param sample_rate: ``int``
+        """
+        self.minutes = minutes
+        self.seed = seed
+        self.sample_rate = sample_rate
+        self.random_state = np.random.RandomState(seed)
+        self.progression = self.random_state.randint(0, 12, (self.CHORUS_SECONDS // self.CHORD_SECONDS, 3))
+
+        # (kind, start, end) of each section, in seconds
+        self.sections = []
+        length = int(minutes * 60)
+        start, num_choruses = 0, 0
+        while start < length:
+            if num_choruses % 3 == 2 and self.sections[-1][0] != "bridge":
+                kind, seconds = "bridge", self.BRIDGE_SECONDS
+            elif not self.sections or self.sections[-1][0] == "chorus":
+                kind, seconds = "verse", self.VERSE_SECONDS
+            else:
+                kind, seconds = "chorus", self.CHORUS_SECONDS
+                num_choruses += 1
+            self.sections.append((kind, start, min(start + seconds, length)))
+            start += seconds
+
+        self._samples = None
+
+    #####-----< Properties >-----#####
+    @property
+    def choruses(self):
+        """
+        :return: ``list`` of two-tuples of the start and end (in seconds) of each chorus
+        """
+        return [(start, end) for kind, start, end in self.sections if kind == "chorus"]
+
+    @property
+    def samples(self):
+        """ the song as int16 samples (generated the first time they're asked for) """
+        if self._samples is None:
+            self._samples = np.empty(int(self.minutes * 60) * self.sample_rate, dtype=np.int16)
+            for kind, start, end in self.sections:
+                self._samples[start * self.sample_rate:end * self.sample_rate] = self._section(kind, end - start)
+        return self._samples
+
+    #####-----< Synthesis >-----#####
+    def _chord(self, notes, seconds, harmonics):
+        """
+        :param notes: ``list`` of semitones above C4
+        :return: float32 ``array`` of the chord (with the given number of harmonics per note), peaking around 1
+        """
+        t = np.arange(int(seconds * self.sample_rate), dtype=np.float32) / self.sample_rate
+        chord = np.zeros(len(t), dtype=np.float32)
+        for note in notes:
+            frequency = 440 * 2 ** ((note - 9) / 12.0)
+            for harmonic in range(1, harmonics + 1):
+                if frequency * harmonic < self.sample_rate / 2:
+                    chord += np.sin(2 * np.pi * frequency * harmonic * t) / harmonic
+        return chord / (len(notes) * sum(1.0 / harmonic for harmonic in range(1, harmonics + 1)))
+
+    def _section(self, kind, seconds):
+        """
+        :return: int16 ``array`` of a section of the given kind and length
+        """
+        num_chords = -(-seconds // self.CHORD_SECONDS)
+        if kind == "chorus":
+            chords, level, harmonics, noise = self.progression, self.CHORUS_LEVEL, self.CHORUS_HARMONICS, \
+                self.CHORUS_NOISE_LEVEL
+        elif kind == "verse":
+            chords, level, harmonics, noise = self.random_state.randint(0, 12, (num_chords, 3)), self.VERSE_LEVEL, \
+                self.VERSE_HARMONICS, self.NOISE_LEVEL
+        else:
+            chords, level, harmonics, noise = self.random_state.randint(0, 12, (num_chords, 1)), self.BRIDGE_LEVEL, \
+                self.VERSE_HARMONICS, self.NOISE_LEVEL
+
+        section = np.concatenate([self._chord(notes, self.CHORD_SECONDS, harmonics) for notes in chords[:num_chords]])
+        section = section[:seconds * self.sample_rate]
+        section += self.random_state.randn(len(section)).astype(np.float32) * noise
+        return (np.clip(section * level, -1, 1) * 32767).astype(np.int16)
+
+    def write(self, path):
+        """ write the song to a mono 16 bit .wav file """
+        wav = wave.open(path, "wb")
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(self.sample_rate)
+        wav.writeframes(self.samples.astype("<i2").tobytes())
+        wav.close()
+
+    def score(self, start, end):
+        """ how well a detected chorus matches the song's choruses
+        :param start: ``float`` the start (in seconds) of the detected chorus, or None if none was found
+        :param end: ``float`` the end (in seconds) of the detected chorus
+        :return: ``dict`` with the distance (in seconds) from the detected start to the nearest chorus start and the
+        overlap (intersection over union) of the detected chorus with the chorus it overlaps most
+        """
+        if start is None:
+            return {"start_error": None, "overlap": 0.0}
+
+        overlap = 0.0
+        for chorus_start, chorus_end in self.choruses:
+            intersection = max(0, min(end, chorus_end) - max(start, chorus_start))
+            overlap = max(overlap, intersection / float(max(end, chorus_end) - min(start, chorus_start)))
+
+        return {"start_error": min(abs(start - chorus_start) for chorus_start, _ in self.choruses),
+                "overlap": overlap}
+
+
+class Benchmark(object):
+    """ times each stage of the analysis over synthetic songs, and compares the throughput of each stage (in samples per
+    second) against a stored baseline """
+    # the stages timed, in the order they're run
+    DECODE, FRAMING, FOURIER, DETECTION = "decode", "framing", "fourier_transform", "find_chorus"
+    # the number of seconds of audio fourier_transform is timed over (it transforms all of its samples at once)
+    FOURIER_SECONDS = 30
+    # the number of times each stage is repeated (the fastest run counts, to keep out noise from the machine)
+    REPEATS = 3
+
+    def __init__(self, minutes=(1, 10, 60), seed=0, sample_rate=22050, methods=(Song.AMPLITUDE, Song.REPETITION),
+                 decoders=None):
+        """
+        :param minutes: ``list`` of the lengths of the songs benchmarked
+        :param seed: ``int`` seeds the songs
+        :param methods: ``list`` of the strategies find_chorus is timed with
+        :param decoders: ``list`` of the names of the decoders compared against each other (defaults to every one which
+        is available)
+        """
+        self.minutes = minutes
+        self.seed = seed
+        self.sample_rate = sample_rate
+        self.methods = methods
+        self.decoders = decoders if decoders is not None else [decoder.NAME for decoder in available_decoders()]
+
+    @classmethod
+    def _measure(cls, function, samples):
+        """ run function REPEATS times
+        :param samples: ``int`` the number of samples function works through
+        :return: two-tuple of the last result of function and a ``dict`` of its fastest time, throughput and the peak
+        memory (in bytes) of the process afterwards
+        """
+        best = None
+        for _ in range(cls.REPEATS):
+            started = time.time()
+            result = function()
+            elapsed = time.time() - started
+            best = elapsed if best is None else min(best, elapsed)
+
+        return result, {"seconds": best, "samples": samples, "throughput": samples / max(best, 1e-9),
+                        "peak_memory": Instrumentation.peak_memory()}
+
+    def _run_song(self, minutes, directory):
+        """
+        :return: ``dict`` of the measurements of every stage for a song of the given length
+        """
+        song = SyntheticSong(minutes=minutes, seed=self.seed, sample_rate=self.sample_rate)
+        path = os.path.join(directory, "{}.wav".format(minutes))
+        song.write(path)
+        num_samples = len(song.samples)
+        stages = {}
+
+        def decode():
+            rate, data = FileUtils(path).get_file_data()
+            # a .wav is memory mapped, so the samples are read end to end to time getting them off disk
+            data.max()
+            return rate, data
+
+        (rate, data), stages[self.DECODE] = self._measure(decode, num_samples)
+        stages.update(self._compare_decoders(song, path))
+
+        table, stages[self.FRAMING] = self._measure(lambda: Song._create_frames(data, rate), len(data))
+
+        excerpt = data[:self.FOURIER_SECONDS * rate]
+        _, stages[self.FOURIER] = self._measure(lambda: SoundUtils.fourier_transform(excerpt, rate), len(excerpt))
+
+        accuracy = {}
+        for method in self.methods:
+            # a fresh table each run, so the spectral features it caches are computed inside the timing
+            def find_chorus():
+                analysed = Song(table=Song._create_frames(data, rate))
+                chorus_start, chorus_end = analysed.find_chorus(method=method)
+                if chorus_start is None:
+                    return None, None
+                return chorus_start.time, chorus_end.end_time if chorus_end else analysed.length
+
+            (start, end), stages["{}:{}".format(self.DETECTION, method)] = self._measure(find_chorus, len(data))
+            accuracy[method] = dict(song.score(start, end), start=start, end=end)
+
+        return {"stages": stages, "accuracy": accuracy}
+
+    def _compare_decoders(self, song, wav_path):
+        """ time each decoder over every type of file it reads which the song can be written as (.wav, and .flac when
+        soundfile is installed)
+        :return: ``dict`` of the measurements of each decoder, keyed by decode:<decoder>:<file type>
+        """
+        paths = {FileType.WAV: wav_path}
+        if decoders.soundfile is not None:
+            paths[FileType.FLAC] = os.path.splitext(wav_path)[0] + FileType.FLAC
+            decoders.soundfile.write(paths[FileType.FLAC], song.samples, song.sample_rate)
+
+        stages = {}
+        for decoder in DECODERS:
+            if decoder.NAME not in self.decoders or not decoder.available():
+                continue
+            for file_type, path in sorted(paths.items()):
+                if decoder.reads(file_type):
+                    _, stages["{}:{}:{}".format(self.DECODE, decoder.NAME, file_type.lstrip("."))] = self._measure(
+                        lambda: FileUtils(path, decoder=decoder.NAME).get_file_data()[1].max(), len(song.samples))
+        return stages
+
+    def run(self):
+        """
+        :return: ``dict`` keyed by song length (in minutes, as a string) of the measurements of each song
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            return dict((str(minutes), self._run_song(minutes, directory)) for minutes in self.minutes)
+        finally:
+            shutil.rmtree(directory)
+
+    @staticmethod
+    def regressions(results, baseline, tolerance):
+        """
+        :param baseline: ``dict`` of earlier results (see run)
+        :param tolerance: ``float`` the fraction of a stage's baseline throughput it may lose before it's a regression
+        :return: ``list`` of ``str`` describing each stage whose throughput fell by more than tolerance, or which the
+        baseline has no measurement of (so it can't be checked)
+        """
+        found = []
+        for minutes, song in sorted(results.items()):
+            for stage, measurements in sorted(song["stages"].items()):
+                expected = baseline.get(minutes, {}).get("stages", {}).get(stage)
+                if expected is None:
+                    found.append("{minutes} minute song, {stage}: not in the baseline (store it with --update-baseline)"
+                                 .format(minutes=minutes, stage=stage))
+                elif measurements["throughput"] < expected["throughput"] * (1 - tolerance):
+                    found.append("{minutes} minute song, {stage}: {actual:.0f} samples/s (baseline {expected:.0f})"
+                                 .format(minutes=minutes, stage=stage, actual=measurements["throughput"],
+                                         expected=expected["throughput"]))
+        return found
+
+    @staticmethod
+    def report(results, output=sys.stdout):
+        """ write a table of the results to output """
+        output.write("{:>7} {:<24} {:>10} {:>14} {:>10}\n".format("minutes", "stage", "seconds", "samples/s",
+                                                                 "peak (MB)"))
+        for minutes, song in sorted(results.items(), key=lambda item: float(item[0])):
+            for stage, measurements in sorted(song["stages"].items()):
+                output.write("{:>7} {:<24} {:>10.3f} {:>14.0f} {:>10.1f}\n".format(
+                    minutes, stage, measurements["seconds"], measurements["throughput"],
+                    measurements["peak_memory"] / float(1 << 20)))
+            for method, accuracy in sorted(song["accuracy"].items()):
+                output.write("{:>7} {:<24} start error {} overlap {:.2f}\n".format(
+                    minutes, "accuracy:" + method, accuracy["start_error"], accuracy["overlap"]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark pychorus over synthetic songs")
+    parser.add_argument("--minutes", type=float, nargs="+", default=[1, 10, 60], help="the lengths of the songs")
+    parser.add_argument("--seed", type=int, default=0, help="seeds the songs")
+    parser.add_argument("--methods", nargs="+",
+                        choices=[Song.AMPLITUDE, Song.REPETITION, Song.FINGERPRINT, Song.SEGMENT],
+                        default=[Song.AMPLITUDE, Song.REPETITION], help="the strategies find_chorus is timed with")
+    parser.add_argument("--decoders", nargs="+", choices=[decoder.NAME for decoder in DECODERS], default=None,
+                        help="the decoders compared against each other (default: every one which is available)")
+    parser.add_argument("--baseline", default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                           "benchmark_baseline.json"),
+                        help="the stored results the throughput is compared against")
+    parser.add_argument("--tolerance", type=float, default=.5,
+                        help="the fraction of its baseline throughput a stage may lose before the run fails")
+    parser.add_argument("--update-baseline", action="store_true", help="store these results as the baseline")
+    args = parser.parse_args()
+
+    minutes = [int(m) if m == int(m) else m for m in args.minutes]
+    results = Benchmark(minutes=minutes, seed=args.seed, methods=args.methods, decoders=args.decoders).run()
+    Benchmark.report(results)
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        sys.exit(0)
+
+    if not os.path.exists(args.baseline):
+        print("no baseline at {}, run with --update-baseline to store one".format(args.baseline))
+        sys.exit(0)
+
+    with open(args.baseline) as f:
+        regressions = Benchmark.regressions(results, json.load(f), args.tolerance)
+    for regression in regressions:
+        print("regression: " + regression)
+    sys.exit(1 if regressions else 0)
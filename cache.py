@@ -0,0 +1,172 @@
+from models import FrameTable
+import numpy as np
+import hashlib
+import json
+import os
+import tempfile
+
+try:
+    from zipfile import BadZipFile
+except ImportError:
+    from zipfile import BadZipfile as BadZipFile
+
+
+class FeatureCache(object):
+    """ an on-disk cache of the frames / features of songs and the choruses found in them. Records are addressed by a
+    hash of the song's contents and of the settings they were calculated with, so renaming or moving a file doesn't
+    invalidate it but changing either the audio or the settings does. Once the cache grows past max_bytes, the least
+    recently used records are evicted
+    """
+    FEATURES, RESULT = ".npz", ".json"
+    # bump when the layout of a record changes, so records written by older versions are never read
+    VERSION = 2
+    # the number of bytes hashed at a time
+    HASH_BLOCK_SIZE = 1 << 20
+
+    def __init__(self, directory, max_bytes=1 << 30):
+        """
+        :param directory: ``str`` where records are stored (created if it doesn't exist)
+        :param max_bytes: ``int`` the size the cache is trimmed back to whenever a record is added
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # (size, modification time) and content hash of each file hashed by this cache, to avoid rehashing unchanged
+        # files
+        self._hashes = {}
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    #####-----< Keys >-----#####
+    def content_hash(self, path):
+        """
+        :return: ``str`` the hex digest of the contents of the file at path
+        """
+        stat = os.stat(path)
+        fingerprint = (stat.st_size, stat.st_mtime)
+        if path in self._hashes and self._hashes[path][0] == fingerprint:
+            return self._hashes[path][1]
+
+        digest = hashlib.sha1()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(self.HASH_BLOCK_SIZE), b""):
+                digest.update(block)
+
+        self._hashes[path] = (fingerprint, digest.hexdigest())
+        return digest.hexdigest()
+
+    def _record_path(self, path, params, extension):
+        """
+        :param params: ``dict`` the (json serialisable) settings the record depends on
+        :return: ``str`` the path of the record for the given file and settings
+        """
+        settings = json.dumps(dict(params, version=self.VERSION), sort_keys=True).encode("utf-8")
+        key = "{content}-{settings}".format(content=self.content_hash(path), settings=hashlib.sha1(settings).hexdigest())
+        return os.path.join(self.directory, key + extension)
+
+    #####-----< Storage >-----#####
+    def _touch(self, record_path):
+        """ mark a record as recently used """
+        try:
+            os.utime(record_path, None)
+        except OSError:
+            pass
+
+    def _remove(self, record_path):
+        try:
+            os.remove(record_path)
+        except OSError:
+            pass
+
+    def _write(self, record_path, write):
+        """ atomically write a record (so a concurrent reader never sees half of one), then trim the cache
+        :param write: callable which writes the record to the file object it's given
+        """
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                write(f)
+            os.rename(temp_path, record_path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+
+        self.evict()
+
+    def evict(self):
+        """ remove the least recently used records until the cache is no bigger than max_bytes """
+        records = []
+        for name in os.listdir(self.directory):
+            if name.endswith((self.FEATURES, self.RESULT)):
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                records.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(size for _, size, _ in records)
+        for _, size, name in sorted(records):
+            if total <= self.max_bytes:
+                break
+            self._remove(os.path.join(self.directory, name))
+            total -= size
+
+    #####-----< Public >-----#####
+    def load_table(self, path, params):
+        """
+        :param path: ``str`` path to the song
+        :param params: ``dict`` the settings the frames were calculated with
+        :return: the cached ``FrameTable`` (without samples) for the song, or None. A record which can't be read (e.g.
+        one cut short by a full disk) is removed, so it's replaced the next time the song is stored
+        """
+        record_path = self._record_path(path, params, self.FEATURES)
+        if not os.path.exists(record_path):
+            return None
+
+        # a damaged record can fail to load in several ways, e.g. zipfile raises RuntimeError (or NotImplementedError)
+        # for some damaged headers
+        try:
+            with np.load(record_path) as record:
+                table = FrameTable.from_columns(int(record["sample_rate"]), record["start"], record["stop"],
+                                                record["amplitude"], frequency_score=record["frequency_score"],
+                                                chroma=record["chroma"], analysed=record["analysed"])
+        except (IOError, OSError, EOFError, ValueError, KeyError, RuntimeError, BadZipFile):
+            self._remove(record_path)
+            return None
+
+        self._touch(record_path)
+        return table
+
+    def store_table(self, path, params, table):
+        """ cache the amplitude envelope and spectral features of a table (calculating the features if need be) """
+        def write(f):
+            np.savez(f, sample_rate=table.sample_rate, start=table.start, stop=table.stop, amplitude=table.amplitude,
+                     frequency_score=table.frequency_scores(), chroma=table.chroma(), analysed=table.analysed)
+
+        self._write(self._record_path(path, params, self.FEATURES), write)
+
+    def load_result(self, path, params):
+        """
+        :param params: ``dict`` the settings the result was found with
+        :return: ``dict`` the cached result (see store_result), or None. A record which can't be read is removed
+        """
+        record_path = self._record_path(path, params, self.RESULT)
+        if not os.path.exists(record_path):
+            return None
+
+        try:
+            with open(record_path) as f:
+                result = json.load(f)
+        except (IOError, OSError, ValueError):
+            self._remove(record_path)
+            return None
+
+        self._touch(record_path)
+        return result
+
+    def store_result(self, path, params, result):
+        """
+        :param result: ``dict`` (json serialisable) result to cache
+        """
+        self._write(self._record_path(path, params, self.RESULT),
+                    lambda f: f.write(json.dumps(result, sort_keys=True).encode("utf-8")))
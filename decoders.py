@@ -0,0 +1,240 @@
+""" the decoders FileUtils reads sound files with. Each decoder is given the ``FileUtils`` of the file (for its path,
+analysis rate and - for the built in decoders - its .wav / ffmpeg readers) and returns the file's mono samples. Decoders
+backed by an optional library are only available when the library is installed, and ffmpeg is the fallback for every
+file type """
+from sound_utils import Decimator, SoundUtils
+import numpy as np
+
+try:
+    import soundfile
+except (ImportError, OSError):
+    # soundfile raises OSError when it's installed but libsndfile isn't
+    soundfile = None
+
+try:
+    import av
+except ImportError:
+    av = None
+
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which
+
+
+class UnsupportedFileType(Exception):
+    pass
+
+
+class DecodeError(Exception):
+    pass
+
+
+class FileType(object):
+    """ the supported types of sound file, and how to recognise them from their first few bytes """
+    MP3, WAV, MP4, FLAC, OGG = ".mp3", ".wav", ".mp4", ".flac", ".ogg"
+    ALL = (MP3, WAV, MP4, FLAC, OGG)
+    # the number of bytes at the start of a file needed to sniff its type
+    SNIFF_BYTES = 12
+
+    @classmethod
+    def sniff(cls, head):
+        """
+        :param head: ``bytes`` the first (up to SNIFF_BYTES) bytes of a file
+        :return: the type of file with the given magic bytes, or None if they aren't recognised
+        """
+        if head[:4] == b"RIFF" and head[8:12] == b"WAVE":
+            return cls.WAV
+        if head[:4] == b"fLaC":
+            return cls.FLAC
+        if head[:4] == b"OggS":
+            return cls.OGG
+        if head[4:8] == b"ftyp":
+            return cls.MP4
+        # an ID3 tag, or the sync word of an MPEG audio frame whose layer bits are set (ADTS AAC frames share the sync
+        # word but have no layer)
+        if head[:3] == b"ID3" or (len(head) >= 2 and ord(head[0:1]) == 0xFF and ord(head[1:2]) & 0xE0 == 0xE0 and
+                                  ord(head[1:2]) & 0x06):
+            return cls.MP3
+        return None
+
+
+class Decoder(object):
+    """ the interface of a decoder """
+    # the name a decoder is selected by
+    NAME = None
+    # the types of file the decoder can read
+    FILE_TYPES = ()
+
+    @classmethod
+    def available(cls):
+        """
+        :return: ``bool`` whether everything the decoder needs is installed
+        """
+        return True
+
+    @classmethod
+    def reads(cls, file_type):
+        """
+        :return: ``bool`` whether the decoder can read the given type of file
+        """
+        return file_type in cls.FILE_TYPES
+
+    @classmethod
+    def decode(cls, file):
+        """
+        :param file: ``FileUtils`` of the file to decode
+        :return: two-tuple of the sample rate and an ``array`` of mono samples (at - or above, for decoders which can
+        only decimate - the file's analysis rate)
+        """
+        raise NotImplementedError()
+
+    @staticmethod
+    def _join(chunks, decimator=None):
+        """ mix down and (optionally) decimate chunks of samples, joining them into a single array
+        :param chunks: iterable of ``array`` of int16 samples with shape (frames, channels)
+        :return: ``array`` of mono samples
+        """
+        mono = ((chunk.sum(axis=1, dtype=np.int32) // chunk.shape[1]).astype(np.int16) for chunk in chunks)
+        if decimator is not None:
+            mono = decimator.decimate(mono)
+        joined = list(mono)
+        return np.concatenate(joined) if joined else np.zeros(0, dtype=np.float32 if decimator else np.int16)
+
+
+class WavDecoder(Decoder):
+    """ reads .wav files in place through a memory mapping (see FileUtils._read_wav) """
+    NAME = "wav"
+    FILE_TYPES = (FileType.WAV,)
+
+    @classmethod
+    def decode(cls, file):
+        try:
+            return file._read_wav(file.path)
+        except UnsupportedFileType as e:
+            # a .wav file whose encoding can't be mapped (e.g. A-law / mu-law or 64 bit float samples) is left to the
+            # decoders which convert it
+            raise DecodeError(str(e))
+
+
+class SoundfileDecoder(Decoder):
+    """ decodes in process with libsndfile (through the soundfile package), which reads .wav, .flac and .ogg files and -
+    from libsndfile 1.1 - .mp3 files """
+    NAME = "soundfile"
+    FILE_TYPES = (FileType.WAV, FileType.FLAC, FileType.OGG, FileType.MP3)
+    # the number of frames decoded at a time
+    FRAMES_PER_CHUNK = 1 << 18
+
+    @classmethod
+    def available(cls):
+        return soundfile is not None
+
+    @classmethod
+    def reads(cls, file_type):
+        # libsndfile only reads .mp3 files from version 1.1
+        return file_type in cls.FILE_TYPES and (file_type != FileType.MP3 or "MP3" in soundfile.available_formats())
+
+    @classmethod
+    def decode(cls, file):
+        try:
+            with soundfile.SoundFile(file.path) as f:
+                factor = SoundUtils.decimation_factor(f.samplerate, file.analysis_rate)
+                samples = cls._join(f.blocks(blocksize=cls.FRAMES_PER_CHUNK, dtype="int16", always_2d=True),
+                                    decimator=Decimator(factor) if factor > 1 else None)
+                return f.samplerate // factor, samples
+        except RuntimeError as e:
+            # libsndfile's errors (soundfile.LibsndfileError in recent versions) are RuntimeErrors
+            raise DecodeError("soundfile failed to decode {path}: {message}".format(path=file.path, message=e))
+
+
+class PyAVDecoder(Decoder):
+    """ decodes in process with ffmpeg's libraries (through the PyAV package, version 9 or later), which read anything
+    the ffmpeg command can. Audio is resampled to exactly the analysis rate, as the ffmpeg command does """
+    NAME = "pyav"
+    FILE_TYPES = FileType.ALL
+
+    @classmethod
+    def available(cls):
+        return av is not None
+
+    @classmethod
+    def decode(cls, file):
+        try:
+            container = av.open(file.path)
+        except av.error.FFmpegError as e:
+            raise DecodeError("pyav failed to open {path}: {message}".format(path=file.path, message=e))
+
+        try:
+            if not container.streams.audio:
+                raise DecodeError("{} has no audio stream".format(file.path))
+            stream = container.streams.audio[0]
+            sample_rate = file.analysis_rate or stream.rate
+            resampler = av.AudioResampler(format="s16", layout="mono", rate=sample_rate)
+
+            def chunks():
+                for frame in container.decode(stream):
+                    for resampled in resampler.resample(frame):
+                        yield resampled.to_ndarray().reshape(-1, 1)
+                # frames the resampler is still holding on to
+                for resampled in resampler.resample(None):
+                    yield resampled.to_ndarray().reshape(-1, 1)
+
+            samples = cls._join(chunks())
+        except av.error.FFmpegError as e:
+            raise DecodeError("pyav failed to decode {path}: {message}".format(path=file.path, message=e))
+        finally:
+            container.close()
+
+        if len(samples) == 0:
+            raise DecodeError("pyav decoded no audio from {}".format(file.path))
+        return sample_rate, samples
+
+
+class FfmpegDecoder(Decoder):
+    """ decodes with an ffmpeg process, either streaming its output straight into memory or converting the file to a
+    .wav file beside it first (see FileUtils.stream) """
+    NAME = "ffmpeg"
+    FILE_TYPES = FileType.ALL
+
+    @classmethod
+    def available(cls):
+        return which("ffmpeg") is not None
+
+    @classmethod
+    def decode(cls, file):
+        if file.stream:
+            return file._decode_stream()
+        return file._read_wav(file._convert_to_wav())
+
+
+# every decoder, in the order they're preferred (in process before spawning ffmpeg)
+DECODERS = (WavDecoder, SoundfileDecoder, PyAVDecoder, FfmpegDecoder)
+
+
+def available_decoders(file_type=None):
+    """
+    :param file_type: one of FileType.ALL, None for every type
+    :return: ``list`` of the available decoders which can read the given type of file, most preferred first
+    """
+    return [decoder for decoder in DECODERS if decoder.available() and
+            (file_type is None or decoder.reads(file_type))]
+
+
+def select_decoder(file_type, name):
+    """
+    :param file_type: one of FileType.ALL
+    :param name: ``str`` the NAME of the decoder to use
+    :return: the ``Decoder`` subclass to decode the file with
+    """
+    decoders = dict((decoder.NAME, decoder) for decoder in DECODERS)
+    if name not in decoders:
+        raise ValueError("unknown decoder {name}, expected one of {names}".format(
+            name=name, names=", ".join(decoder.NAME for decoder in DECODERS)))
+
+    decoder = decoders[name]
+    if not decoder.available():
+        raise DecodeError("the {} decoder isn't available (its library isn't installed)".format(name))
+    if not decoder.reads(file_type):
+        raise UnsupportedFileType("the {name} decoder can't read {file_type} files".format(name=name,
+                                                                                           file_type=file_type))
+    return decoder
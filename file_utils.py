@@ -1,17 +1,120 @@
+from decoders import DecodeError, FileType, UnsupportedFileType, available_decoders, select_decoder
+from instrumentation import Instrumentation
+from sound_utils import Decimator, SoundUtils
 import subprocess
-import wave
+import logging
+import struct
+import os
+import tempfile
 import numpy as np
 import pdb
 
-class UnsupportedFileType(Exception):
-    pass
+logger = logging.getLogger("pychorus.file_utils")
+
+
+class WavHeader(object):
+    """ the parts of a .wav file's header needed to read its samples in place """
+    PCM, IEEE_FLOAT, EXTENSIBLE = 1, 3, 0xFFFE
+
+    def __init__(self, format_tag=None, num_channels=None, sample_rate=None, sample_width=None, data_offset=None,
+                 num_frames=None):
+        """
+        :param format_tag: ``int`` one of PCM or IEEE_FLOAT
+        :param num_channels: ``int``
+        :param sample_rate: ``int``
+        :param sample_width: ``int`` the number of bytes in a single sample of a single channel
+        :param data_offset: ``int`` offset (in bytes) of the first sample from the start of the file
+        :param num_frames: ``int`` the number of samples in each channel
+        """
+        self.format_tag = format_tag
+        self.num_channels = num_channels
+        self.sample_rate = sample_rate
+        self.sample_width = sample_width
+        self.data_offset = data_offset
+        self.num_frames = num_frames
+
+    @classmethod
+    def read(cls, path):
+        """ parse the RIFF chunks of the .wav file at path up to the start of its sample data
+        :return: ``WavHeader``
+        """
+        header = cls()
+        file_size = os.path.getsize(path)
+
+        with open(path, "rb") as f:
+            riff, _, wave_id = struct.unpack("<4sI4s", FileUtils._read_exactly(f, 12))
+            if riff != b"RIFF" or wave_id != b"WAVE":
+                raise UnsupportedFileType("{} is not a RIFF/WAVE file".format(path))
+
+            while True:
+                chunk_id, chunk_size = struct.unpack("<4sI", FileUtils._read_exactly(f, 8))
+                if chunk_id == b"data":
+                    header.data_offset = f.tell()
+                    # the size of a streamed (or truncated) file's data chunk can't be trusted, so never read past the
+                    # end of the file
+                    data_size = min(chunk_size, file_size - header.data_offset)
+                    break
+
+                chunk = FileUtils._read_exactly(f, chunk_size + (chunk_size % 2))
+                if chunk_id == b"fmt ":
+                    header.format_tag, header.num_channels, header.sample_rate, _, _, bits = \
+                        struct.unpack("<HHIIHH", chunk[:16])
+                    header.sample_width = (bits + 7) // 8
+                    if header.format_tag == cls.EXTENSIBLE:
+                        # the actual format is the first two bytes of the sub format GUID
+                        header.format_tag = struct.unpack("<H", chunk[24:26])[0]
+
+        if header.sample_rate is None:
+            raise UnsupportedFileType("{} has no format chunk".format(path))
+        if header.format_tag not in (cls.PCM, cls.IEEE_FLOAT) or not 1 <= header.sample_width <= 4:
+            raise UnsupportedFileType("unsupported .wav encoding (format {fmt}, {width} byte samples)".format(
+                fmt=header.format_tag, width=header.sample_width))
+
+        header.num_frames = data_size // (header.sample_width * header.num_channels)
+        return header
+
+    def to_bytes(self, num_frames):
+        """ build a canonical header for a file holding num_frames of audio in this header's format
+        :return: ``bytes``
+        """
+        block_align = self.num_channels * self.sample_width
+        data_size = num_frames * block_align
+        # the RIFF size covers everything after itself, including the pad byte of an odd sized data chunk
+        riff_size = 36 + data_size + (data_size % 2)
+
+        return struct.pack("<4sI4s4sIHHIIHH4sI", b"RIFF", riff_size, b"WAVE", b"fmt ", 16, self.format_tag,
+                           self.num_channels, self.sample_rate, self.sample_rate * block_align, block_align,
+                           self.sample_width * 8, b"data", data_size)
 
 
 class FileUtils(object):
-    MP3, WAV, MP4 = ".mp3", ".wav", ".mp4"
+    MP3, WAV, MP4, FLAC, OGG = FileType.MP3, FileType.WAV, FileType.MP4, FileType.FLAC, FileType.OGG
+    # the number of bytes read from the decoder's stdout at a time
+    CHUNK_SIZE = 1 << 16
+    # the number of seconds of audio the decode buffer initially has room for (the buffer grows if a file is longer)
+    INITIAL_BUFFER_SECONDS = 300
+    # the number of frames converted / mixed down at a time when reading a .wav file
+    FRAMES_PER_CHUNK = 1 << 18
 
-    def __init__(self, path):
+    def __init__(self, path, stream=True, analysis_rate=None, decoder=None):
+        """
+        :param path: ``str`` path to the sound file
+        :param stream: ``bool`` if True, non .wav files are decoded by streaming PCM from ffmpeg straight into memory,
+        otherwise they are first converted to a .wav file which is written beside the original
+        :param analysis_rate: ``int`` the sampling rate (in hz) the file is read at, None for its own rate. ffmpeg
+        resamples other files to exactly this rate as it decodes them, while .wav files are decimated by the largest
+        whole factor which keeps them at or above it (see SoundUtils.decimation_factor). Times (in seconds) are the
+        same at either rate
+        :param decoder: ``str`` the name of the decoder to read the file with (see decoders.DECODERS), None to use the
+        most preferred one which is available for the file's type, falling back on the others (and finally ffmpeg) if it
+        fails
+        """
         self.path = path
+        self.stream = stream
+        self.analysis_rate = analysis_rate
+        self.decoder = decoder
+        # the NAME of the decoder get_file_data last read the file with
+        self.decoded_with = None
 
     def _convert_to_wav(self):
         """
@@ -20,31 +123,422 @@ class FileUtils(object):
         """
         file_type = self._get_file_type(self.path)
         if file_type != self.WAV:
-            wav_path = "{stripped}.wav".format(stripped=self.path.replace(file_type, ""))
-            subprocess.call("ffmpeg -i {path} -ac 1 {wav}".format(path=self.path, wav=wav_path), shell=True)
+            wav_path = os.path.splitext(self.path)[0] + self.WAV
+            if wav_path == self.path:
+                # the file is named .wav but isn't one
+                wav_path = self.path + self.WAV
+            self._run_ffmpeg(["-i", self.path, "-ac", "1"] + self._resample_args() + [wav_path])
         else:
             wav_path = self.path
 
         return wav_path
 
     def _get_file_type(self, path):
-        """return one of of the supported file types depending on the file type for this utils' file"""
+        """ the type of the file at path, sniffed from its first few bytes. The file's extension is only used when its
+        contents aren't recognised (or it can't be read)
+        :return: one of FileType.ALL
+        """
         try:
-            return [t for t in [self.MP3, self.WAV, self.MP4] if t in path][0]
-        except IndexError:
-            raise UnsupportedFileType()
+            with open(path, "rb") as f:
+                head = f.read(FileType.SNIFF_BYTES)
+        except (IOError, OSError):
+            head = b""
+
+        file_type = FileType.sniff(head) or os.path.splitext(path)[1].lower()
+        if file_type not in FileType.ALL:
+            raise UnsupportedFileType("{} is not a supported sound file".format(path))
+        return file_type
+
+    def _resample_args(self):
+        """
+        :return: ``list`` of the ffmpeg arguments which resample the output to the analysis rate (if there is one)
+        """
+        return ["-ar", str(self.analysis_rate)] if self.analysis_rate else []
+
+    def _run_ffmpeg(self, args, stdout=None):
+        """ start ffmpeg with the given arguments (an argument list is used rather than a shell string, so paths never
+        need quoting)
+        :param args: ``list`` of arguments to pass to ffmpeg
+        :param stdout: where ffmpeg's stdout should go (e.g. ``subprocess.PIPE``), None to wait for ffmpeg to finish
+        :return: the running ``subprocess.Popen`` if stdout was given, otherwise None
+        """
+        errors = tempfile.TemporaryFile()
+        try:
+            process = subprocess.Popen(["ffmpeg", "-nostdin", "-v", "error"] + args, stdout=stdout, stderr=errors)
+        except OSError as e:
+            errors.close()
+            raise DecodeError("unable to run ffmpeg: {}".format(e))
+
+        process.errors = errors
+        if stdout is None:
+            self._wait_for_ffmpeg(process)
+            return None
+        return process
 
-    def get_file_data(self):
-        """get file data associated with this file, including it's sample rate and raw data"""
+    def _wait_for_ffmpeg(self, process):
+        """ wait for the given ffmpeg process to exit, raising a ``DecodeError`` holding ffmpeg's own error output if
+        it failed
+        """
+        return_code = process.wait()
+        process.errors.seek(0)
+        message = process.errors.read().decode("utf-8", "replace").strip()
+        process.errors.close()
+
+        if return_code != 0:
+            raise DecodeError("ffmpeg failed to decode {path} (exit code {code}): {message}".format(
+                path=self.path, code=return_code, message=message))
+
+    @staticmethod
+    def _read_exactly(stream, num_bytes):
+        data = stream.read(num_bytes)
+        if len(data) != num_bytes:
+            raise DecodeError("unexpected end of stream while reading the wav header")
+        return data
+
+    @classmethod
+    def _read_stream_header(cls, stream):
+        """ read the header of the .wav stream ffmpeg writes to a pipe, stopping at the start of the sample data (the
+        chunk sizes in a piped header are placeholders, so they are never used to find the end of the data)
+        :return: two-tuple of the sample rate and the number of channels in the stream
+        """
+        riff, _, wave_id = struct.unpack("<4sI4s", cls._read_exactly(stream, 12))
+        if riff != b"RIFF" or wave_id != b"WAVE":
+            raise DecodeError("ffmpeg did not produce a wav stream")
+
+        sample_rate = num_channels = None
+        while True:
+            chunk_id, chunk_size = struct.unpack("<4sI", cls._read_exactly(stream, 8))
+            if chunk_id == b"data":
+                break
+
+            chunk = cls._read_exactly(stream, chunk_size + (chunk_size % 2))
+            if chunk_id == b"fmt ":
+                _, num_channels, sample_rate = struct.unpack("<HHI", chunk[:8])
+
+        if sample_rate is None:
+            raise DecodeError("ffmpeg produced a wav stream without a format chunk")
+
+        return sample_rate, num_channels
+
+    def _stream_pcm(self):
+        """ decode self.path with ffmpeg, reading mono 16 bit PCM from its stdout
+        :return: two-tuple of the sample rate and a generator of ``array`` of int16 sample chunks
+        """
+        process = self._run_ffmpeg(["-i", self.path, "-vn", "-ac", "1"] + self._resample_args() +
+                                   ["-acodec", "pcm_s16le", "-f", "wav", "-"], stdout=subprocess.PIPE)
+        try:
+            sample_rate, _ = self._read_stream_header(process.stdout)
+        except DecodeError:
+            process.stdout.close()
+            # ffmpeg's own error is more useful than the malformed header, if it has one
+            self._wait_for_ffmpeg(process)
+            raise
+
+        def chunks():
+            leftover = b""
+            try:
+                while True:
+                    data = process.stdout.read(self.CHUNK_SIZE)
+                    if not data:
+                        break
+
+                    data = leftover + data
+                    usable = len(data) - (len(data) % 2)
+                    leftover = data[usable:]
+                    yield np.frombuffer(data[:usable], dtype="<i2")
+            except GeneratorExit:
+                # the chunks weren't all read, so ffmpeg is stopped rather than waited for
+                process.stdout.close()
+                if process.poll() is None:
+                    process.kill()
+                process.wait()
+                process.errors.close()
+                raise
+
+            # ffmpeg can fail after writing some of the audio, and may not have exited yet when its output ends, so
+            # it's always waited for
+            process.stdout.close()
+            self._wait_for_ffmpeg(process)
+
+        return sample_rate, chunks()
+
+    def _decode_stream(self):
+        """ decode self.path without writing an intermediate file, copying the decoded chunks into a preallocated
+        buffer (which is doubled whenever it fills up)
+        :return: two-tuple of the sample rate and an ``array`` of the decoded samples
+        """
+        sample_rate, chunks = self._stream_pcm()
+
+        buf = np.empty(sample_rate * self.INITIAL_BUFFER_SECONDS, dtype=np.int16)
+        num_samples = 0
+        for chunk in chunks:
+            if num_samples + len(chunk) > len(buf):
+                grown = np.empty(max(2 * len(buf), num_samples + len(chunk)), dtype=np.int16)
+                grown[:num_samples] = buf[:num_samples]
+                buf = grown
+
+            buf[num_samples:num_samples + len(chunk)] = chunk
+            num_samples += len(chunk)
+
+        if num_samples == 0:
+            raise DecodeError("ffmpeg decoded no audio from {}".format(self.path))
+
+        buf.resize(num_samples, refcheck=False)
+        return sample_rate, buf
+
+    @staticmethod
+    def _wav_sample_dtype(header):
+        """
+        :return: two-tuple of the numpy dtype the samples are stored as in the file and the dtype they are read as
+        """
+        if header.format_tag == WavHeader.IEEE_FLOAT:
+            if header.sample_width != 4:
+                raise UnsupportedFileType("only 32 bit float .wav files are supported")
+            return np.dtype("<f4"), np.dtype(np.float32)
+
+        # 8 bit samples are unsigned, and 24 bit samples have no numpy type so they are stored as raw bytes
+        return {
+            1: (np.dtype(np.uint8), np.dtype(np.int16)),
+            2: (np.dtype("<i2"), np.dtype(np.int16)),
+            3: (np.dtype(np.uint8), np.dtype(np.int32)),
+            4: (np.dtype("<i4"), np.dtype(np.int32)),
+        }[header.sample_width]
+
+    @staticmethod
+    def _convert_samples(raw, header):
+        """ convert a chunk of samples from the way they are stored in the file to signed samples
+        :param raw: ``array`` of samples, with shape (frames, channels) or - for 24 bit audio - (frames, channels, 3)
+        :return: ``array`` of signed samples with shape (frames, channels)
+        """
+        if header.sample_width == 1 and header.format_tag == WavHeader.PCM:
+            return (raw.astype(np.int16) - 128) << 8
+        if header.sample_width == 3:
+            samples = raw[..., 0].astype(np.int32) | (raw[..., 1].astype(np.int32) << 8) | \
+                (raw[..., 2].astype(np.int32) << 16)
+            # sign extend from 24 to 32 bits
+            return (samples << 8) >> 8
+        return raw
+
+    @staticmethod
+    def _unconvert_samples(samples, header):
+        """ the inverse of _convert_samples: convert signed samples back to the way they are stored in the file """
+        if header.sample_width == 1 and header.format_tag == WavHeader.PCM:
+            return ((samples >> 8) + 128).astype(np.uint8)
+        if header.sample_width == 3:
+            return samples.astype("<i4").view(np.uint8).reshape(samples.shape + (4,))[..., :3]
+        return samples
+
+    def _map_wav(self, path):
+        """ memory map the data chunk of a .wav file
+        :return: two-tuple of the file's ``WavHeader`` and a read only ``array`` of its samples as they are stored, with
+        shape (frames, channels) or - for 24 bit audio - (frames, channels, 3). The array is None if the file is empty
+        """
+        header = WavHeader.read(path)
+        stored_dtype, _ = self._wav_sample_dtype(header)
+
+        if header.num_frames == 0:
+            return header, None
+
+        shape = (header.num_frames, header.num_channels)
+        if header.sample_width == 3:
+            shape += (3,)
+        return header, np.memmap(path, dtype=stored_dtype, mode="r", offset=header.data_offset, shape=shape)
+
+    def _read_wav(self, path):
+        """ read the samples of a .wav file without copying them. The data chunk is memory mapped and - for mono 8/16/32
+        bit files - returned as a read only view. Other files are converted / mixed down to mono a chunk at a time, so
+        only the mono result is ever held in memory
+        :return: two-tuple of the sample rate and an ``array`` of mono samples
+        """
+        header, raw = self._map_wav(path)
+        stored_dtype, sample_dtype = self._wav_sample_dtype(header)
+        decimator = self._wav_decimator(header)
+
+        if raw is None:
+            return header.sample_rate, np.zeros(0, dtype=sample_dtype)
+
+        if decimator is not None:
+            samples = np.empty(decimator.num_outputs(header.num_frames), dtype=np.float32)
+            start = 0
+            for chunk in decimator.decimate(self._wav_chunks(header, raw)):
+                samples[start:start + len(chunk)] = chunk
+                start += len(chunk)
+            return header.sample_rate // decimator.factor, samples
+
+        if header.num_channels == 1 and stored_dtype == sample_dtype:
+            return header.sample_rate, raw[:, 0]
+
+        samples = np.empty(header.num_frames, dtype=sample_dtype)
+        start = 0
+        for chunk in self._wav_chunks(header, raw):
+            samples[start:start + len(chunk)] = chunk
+            start += len(chunk)
+
+        return header.sample_rate, samples
+
+    def _wav_decimator(self, header):
+        """
+        :return: the ``Decimator`` which brings a .wav file down to the analysis rate, or None if it's already there
+        """
+        factor = SoundUtils.decimation_factor(header.sample_rate, self.analysis_rate)
+        return Decimator(factor) if factor > 1 else None
+
+    def _wav_chunks(self, header, raw):
+        """ convert and mix down the memory mapped samples of a .wav file a chunk at a time
+        :return: generator of ``array`` of mono samples
+        """
+        _, sample_dtype = self._wav_sample_dtype(header)
+
+        for start in range(0, header.num_frames, self.FRAMES_PER_CHUNK):
+            chunk = self._convert_samples(raw[start:start + self.FRAMES_PER_CHUNK], header)
+
+            if sample_dtype.kind == "f":
+                yield chunk.mean(axis=1).astype(sample_dtype)
+            else:
+                yield (chunk.sum(axis=1, dtype=np.int64) // header.num_channels).astype(sample_dtype)
+
+    def stream_file_data(self):
+        """ get the data of this file a chunk at a time, without ever holding the whole file in memory (for .wav files
+        the chunks are read from a memory mapping, anything else is streamed from ffmpeg)
+        :return: two-tuple of the sample rate and a generator of ``array`` of mono samples
+        """
+        if self._get_file_type(self.path) != self.WAV:
+            return self._stream_pcm()
+
+        header, raw = self._map_wav(self.path)
+        if raw is None:
+            return header.sample_rate, iter([])
+
+        decimator = self._wav_decimator(header)
+        if decimator is not None:
+            return header.sample_rate // decimator.factor, decimator.decimate(self._wav_chunks(header, raw))
+        return header.sample_rate, self._wav_chunks(header, raw)
+
+    def decoders(self):
+        """
+        :return: ``list`` of the decoders get_file_data tries, in order
+        """
         file_type = self._get_file_type(self.path)
+        if self.decoder is not None:
+            return [select_decoder(file_type, self.decoder)]
+
+        decoders = available_decoders(file_type)
+        if not decoders:
+            raise DecodeError("no decoder is available for {} files (is ffmpeg installed?)".format(file_type))
+        return decoders
+
+    def get_file_data(self, decoders=None):
+        """get file data associated with this file, including it's sample rate and raw data
+        :param decoders: ``list`` of the decoders to try, in order (defaults to self.decoders())
+        """
+        decoders = decoders or self.decoders()
+
+        with Instrumentation.stage(Instrumentation.DECODE) as stage:
+            for decoder in decoders:
+                try:
+                    rate, data = decoder.decode(self)
+                    self.decoded_with = decoder.NAME
+                    break
+                except DecodeError as e:
+                    if decoder is decoders[-1]:
+                        raise
+                    logger.debug("the %s decoder failed (%s), falling back on the next", decoder.NAME, e)
+            stage.samples = len(data)
+
+        return rate, data
+
+    #####-----< Writing Segments >-----#####
+    def _apply_fades(self, raw, header, positions, first, last, fade_in, fade_out):
+        """ scale a chunk of stored samples by the fade in / out gain at each of their positions
+        :param raw: ``array`` of stored samples
+        :param positions: ``array`` of the frame index of each sample in raw
+        :param first: ``int`` the index of the first frame of the segment being faded
+        :param last: ``int`` the index of the frame after the end of the segment being faded
+        :param fade_in: ``int`` the number of frames the fade in lasts (starting at first)
+        :param fade_out: ``int`` the number of frames the fade out lasts (ending at last)
+        :return: ``array`` of stored samples
+        """
+        gain = np.ones(len(positions))
+        if fade_in:
+            gain = np.minimum(gain, (positions - first + 1) / float(fade_in))
+        if fade_out:
+            gain = np.minimum(gain, (last - positions) / float(fade_out))
+
+        samples = self._convert_samples(raw, header)
+        faded = samples * gain.reshape((-1,) + (1,) * (samples.ndim - 1))
+        if samples.dtype.kind != "f":
+            info = np.iinfo(samples.dtype)
+            faded = np.clip(np.round(faded), info.min, info.max)
+
+        return self._unconvert_samples(faded.astype(samples.dtype), header)
 
-        # 1: convert the file if necessary to .wav format
-        wav_path = self._convert_to_wav()
+    def _write_wav_segments(self, segments, fade_in, fade_out):
+        """ write segments of a .wav file by copying them straight out of the memory mapped data chunk, so they are
+        sample accurate and keep the original channels and format. Only chunks overlapping a fade are converted
+        """
+        header, raw = self._map_wav(self.path)
+
+        for start, end, output_path in segments:
+            first = min(max(int(round(start * header.sample_rate)), 0), header.num_frames)
+            last = min(max(int(round(end * header.sample_rate)), first), header.num_frames)
+            fade_in_frames = min(int(round(fade_in * header.sample_rate)), (last - first) // 2)
+            fade_out_frames = min(int(round(fade_out * header.sample_rate)), (last - first) // 2)
+
+            with open(output_path, "wb") as f:
+                f.write(header.to_bytes(last - first))
+
+                for chunk_start in range(first, last, self.FRAMES_PER_CHUNK):
+                    chunk_stop = min(chunk_start + self.FRAMES_PER_CHUNK, last)
+                    chunk = raw[chunk_start:chunk_stop]
+
+                    if chunk_start < first + fade_in_frames or chunk_stop > last - fade_out_frames:
+                        chunk = self._apply_fades(chunk, header, np.arange(chunk_start, chunk_stop), first, last,
+                                                  fade_in_frames, fade_out_frames)
+                    f.write(np.ascontiguousarray(chunk).tobytes())
+
+                if ((last - first) * header.num_channels * header.sample_width) % 2:
+                    f.write(b"\0")
+
+    def _cut_segment(self, start, end, output_path, fade_in, fade_out):
+        """ cut a segment out of a compressed file with ffmpeg. ffmpeg seeks to the segment before decoding, and if the
+        output has the same format as the input (and there are no fades) the audio is stream copied rather than
+        re-encoded. Stream copied cuts can only start on a packet boundary of the original, so they aren't sample
+        accurate
+        """
+        duration = max(end - start, 0)
+        same_format = os.path.splitext(output_path)[1].lower() == os.path.splitext(self.path)[1].lower()
+
+        args = ["-y", "-ss", "{:.6f}".format(start), "-i", self.path, "-t", "{:.6f}".format(duration), "-map", "0:a"]
+        if fade_in or fade_out:
+            fades = []
+            if fade_in:
+                fades.append("afade=t=in:st=0:d={:.6f}".format(fade_in))
+            if fade_out:
+                fades.append("afade=t=out:st={:.6f}:d={:.6f}".format(max(duration - fade_out, 0), fade_out))
+            args += ["-af", ",".join(fades)]
+        elif same_format:
+            args += ["-c", "copy"]
+
+        self._run_ffmpeg(args + [output_path])
+
+    def write_segments(self, segments, fade_in=0, fade_out=0):
+        """ write several segments of this file, each to its own file
+        :param segments: ``list`` of three-tuples of the start and end of a segment (in seconds) and the path to write
+        it to. Segments written to a .wav file from a .wav file are copied sample accurately, anything else is cut with
+        ffmpeg
+        :param fade_in: ``float`` the number of seconds to fade each segment in over
+        :param fade_out: ``float`` the number of seconds to fade each segment out over
+        """
+        wav_segments = []
+        for start, end, output_path in segments:
+            if self._get_file_type(self.path) == self.WAV and output_path.lower().endswith(self.WAV):
+                wav_segments.append((start, end, output_path))
+            else:
+                self._cut_segment(start, end, output_path, fade_in, fade_out)
 
-        # 2: get the file data
-        spf = wave.open(wav_path, 'r')
-        signal = spf.readframes(-1)
-        signal = np.fromstring(signal, 'Int16')
+        if wav_segments:
+            self._write_wav_segments(wav_segments, fade_in, fade_out)
 
-        sample_rate, wav_data = spf.getframerate(), signal
-        return sample_rate, wav_data
\ No newline at end of file
+    def write_segment(self, start, end, output_path, fade_in=0, fade_out=0):
+        """ write the segment of this file between start and end (in seconds) to output_path (see write_segments) """
+        self.write_segments([(start, end, output_path)], fade_in=fade_in, fade_out=fade_out)
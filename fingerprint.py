@@ -0,0 +1,280 @@
+from sound_utils import SoundUtils
+import numpy as np
+import math
+
+
+class RepeatedSegment(object):
+    """ a segment of a track found (by a ``FingerprintIndex``) to repeat """
+    __slots__ = ("start", "end", "repetitions", "confidence", "occurrences")
+
+    def __init__(self, start=None, end=None, repetitions=None, confidence=None, occurrences=None):
+        """
+        :param start: ``float`` the offset (in seconds) of the start of the segment
+        :param end: ``float`` the offset (in seconds) of the end of the segment
+        :param repetitions: ``int`` the number of times the segment was found in the track (including itself)
+        :param confidence: ``float`` between 0 and 1, how far the votes for the offset of the segment's strongest repeat
+        stand out from the votes for offsets in general
+        :param occurrences: ``list`` of the offset (in seconds) of the start of every occurrence, in order
+        """
+        self.start = start
+        self.end = end
+        self.repetitions = repetitions
+        self.confidence = confidence
+        self.occurrences = occurrences
+
+    def __repr__(self):
+        return "{start} - {end} (x{repetitions}, {confidence:.2f})".format(
+            start=self.start, end=self.end, repetitions=self.repetitions, confidence=self.confidence)
+
+
+class FingerprintIndex(object):
+    """ an in-memory inverted index of the spectral fingerprints of a track, used to find repeated segments in roughly
+    linear time. The peaks of the track's spectrogram (bins louder than everything around them in both time and
+    frequency) are found, and each peak is paired with the next few peaks after it to make a landmark whose hash is the
+    frequency of both peaks and the time between them. Landmarks are sorted into an index mapping each hash to the
+    times it occurs at, and every pair of occurrences of a hash votes for the offset between them. Segments which repeat
+    show up as offsets with many votes, without ever comparing every pair of windows
+    """
+    # the length / spacing (in seconds) of the windows of the spectrogram
+    WINDOW_SECONDS = .1
+    HOP_SECONDS = .05
+    # (low, high) bounds (in hz) of the frequencies peaks are looked for in
+    FREQUENCY_RANGE = (100, 4000)
+    # a peak has to be the loudest bin within this many seconds / bins of it, and this many decibels louder than the
+    # median bin (of the windows transformed alongside it)
+    PEAK_SECONDS = .25
+    PEAK_BINS = 5
+    PEAK_FLOOR_DB = 9
+    # each peak is paired with (at most) this many of the peaks following it, within TARGET_SECONDS of it
+    FAN_OUT = 5
+    TARGET_SECONDS = 2
+    # each occurrence of a hash is paired with (at most) this many of the occurrences following it (from the smallest
+    # offset looked for), so common hashes can't make the number of votes quadratic
+    MAX_NEIGHBOURS = 8
+    # the number of windows transformed at a time while fingerprinting
+    WINDOWS_PER_BATCH = 2048
+    # the number of seconds which may pass between matched landmarks of a segment before it's considered to have ended
+    MAX_GAP_SECONDS = 6
+    # an offset counts as another repetition of a segment if it has at least this fraction of the votes of the
+    # segment's strongest repeat
+    REPETITION_VOTES = .5
+    # the number of bits of a landmark's window index in the keys the index is searched by
+    TIME_BITS = 24
+
+    def __init__(self, samples, sample_rate, spans=None):
+        """
+        :param samples: ``array`` of samples
+        :param sample_rate: ``int``
+        :param spans: two-tuple of ``array`` of the first and last (exclusive) sample offset of the only parts of the
+        track which are fingerprinted (e.g. FrameTable.analysed_spans), None for all of it
+        """
+        self.sample_rate = sample_rate
+        self.num_windows = len(self.windows(len(samples), sample_rate)[2])
+        peak_windows, peak_bins = self.peaks(samples, sample_rate, spans=spans)
+        # the window index, hash and end (the window index of the second peak) of every landmark, in order
+        self.times, self.hashes, self.ends = self.landmarks(peak_windows, peak_bins)
+
+        # the inverted index: the landmarks of every hash, grouped by hash and in order within each group
+        self.order = np.argsort(self.hashes, kind="mergesort")
+        self.sorted_hashes = self.hashes[self.order]
+        self.sorted_keys = (self.sorted_hashes << self.TIME_BITS) | self.times[self.order]
+
+    #####-----< Fingerprinting >-----#####
+    @classmethod
+    def windows(cls, num_samples, sample_rate):
+        """
+        :return: three-tuple of the length (a power of two) and spacing (in samples) of the windows of the spectrogram,
+        and an ``array`` of the offset of every window
+        """
+        n_fft = 2 ** int(round(math.log(cls.WINDOW_SECONDS * sample_rate, 2)))
+        hop_length = max(int(round(cls.HOP_SECONDS * sample_rate)), 1)
+        return n_fft, hop_length, np.arange(0, max(num_samples - n_fft + 1, 0), hop_length)
+
+    @staticmethod
+    def _neighbourhood_max(values, radius, axis):
+        """
+        :return: ``array`` of the largest of values within radius places of each value along the given axis
+        """
+        result = values.copy()
+        for shift in range(1, radius + 1):
+            ahead, behind = [slice(None)] * values.ndim, [slice(None)] * values.ndim
+            ahead[axis], behind[axis] = slice(shift, None), slice(None, -shift)
+            np.maximum(result[tuple(ahead)], values[tuple(behind)], out=result[tuple(ahead)])
+            np.maximum(result[tuple(behind)], values[tuple(ahead)], out=result[tuple(behind)])
+        return result
+
+    @classmethod
+    def peaks(cls, samples, sample_rate, spans=None):
+        """
+        :param spans: two-tuple of ``array`` of the first and last (exclusive) sample offset of the only parts of the
+        track which are fingerprinted, None for all of it
+        :return: two-tuple of ``array`` of the window index and frequency bin of every peak, in order
+        """
+        n_fft, hop_length, starts = cls.windows(len(samples), sample_rate)
+        frequencies = np.fft.rfftfreq(n_fft, 1.0 / sample_rate)
+        band = (frequencies >= cls.FREQUENCY_RANGE[0]) & (frequencies < cls.FREQUENCY_RANGE[1])
+
+        # only the windows which lie within a span are transformed
+        within = np.ones(len(starts), dtype=bool)
+        if spans is not None:
+            span_starts, span_stops = spans
+            within[:] = False
+            if len(span_starts):
+                span = np.searchsorted(span_starts, starts, side="right") - 1
+                within = (span >= 0) & (starts + n_fft <= np.asarray(span_stops)[np.maximum(span, 0)])
+
+        # batches overlap by the size of a peak's neighbourhood, so peaks at the edges of a batch are compared with
+        # all of their neighbours
+        radius = max(int(round(cls.PEAK_SECONDS / cls.HOP_SECONDS)), 1)
+        peak_windows, peak_bins = [np.zeros(0, dtype=int)], [np.zeros(0, dtype=int)]
+        for first in range(0, len(starts), cls.WINDOWS_PER_BATCH):
+            last = min(first + cls.WINDOWS_PER_BATCH, len(starts))
+            low, high = max(first - radius, 0), min(last + radius, len(starts))
+            transformed = within[low:high]
+            if not transformed[first - low:last - low].any():
+                continue
+
+            # windows which aren't transformed are left silent, so they never hold a peak
+            _, powers = SoundUtils.stft(samples, sample_rate, n_fft=n_fft, starts=starts[low:high][transformed])
+            decibels = np.full((high - low, band.sum()), -np.inf, dtype=np.float32)
+            decibels[transformed] = 10 * np.log10(powers[:, band] + np.finfo(np.float32).tiny)
+
+            loudest = cls._neighbourhood_max(cls._neighbourhood_max(decibels, radius, 0), cls.PEAK_BINS, 1)
+            floor = np.median(decibels[transformed]) + cls.PEAK_FLOOR_DB
+            windows, bins = np.nonzero((decibels == loudest) & (decibels > floor))
+
+            keep = (windows >= first - low) & (windows < last - low)
+            peak_windows.append(windows[keep] + low)
+            peak_bins.append(bins[keep])
+
+        return np.concatenate(peak_windows), np.concatenate(peak_bins)
+
+    @classmethod
+    def landmarks(cls, peak_windows, peak_bins):
+        """ pair each peak with the (at most FAN_OUT) peaks following it within TARGET_SECONDS
+        :param peak_windows: ``array`` of the window index of every peak, in order
+        :param peak_bins: ``array`` of the frequency bin of every peak
+        :return: three-tuple of ``array`` of the window index, hash and end of every landmark, in order
+        """
+        max_windows = max(int(round(cls.TARGET_SECONDS / cls.HOP_SECONDS)), 1)
+        # the first peak in a later window than each peak
+        following = np.searchsorted(peak_windows, peak_windows + 1)
+
+        times, hashes, ends = [np.zeros(0, dtype=int)], [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=int)]
+        for k in range(cls.FAN_OUT):
+            anchors = np.flatnonzero(following + k < len(peak_windows))
+            targets = following[anchors] + k
+            distances = peak_windows[targets] - peak_windows[anchors]
+            close = distances <= max_windows
+            anchors, targets, distances = anchors[close], targets[close], distances[close]
+
+            times.append(peak_windows[anchors])
+            ends.append(peak_windows[targets])
+            hashes.append((peak_bins[anchors].astype(np.int64) << 20) | (peak_bins[targets].astype(np.int64) << 8) |
+                          distances)
+
+        times = np.concatenate(times)
+        order = np.argsort(times, kind="mergesort")
+        return times[order], np.concatenate(hashes)[order], np.concatenate(ends)[order]
+
+    def seconds(self, window):
+        """
+        :return: ``float`` the offset (in seconds) of the middle of the window with the given index
+        """
+        return window * self.HOP_SECONDS + self.WINDOW_SECONDS / 2
+
+    def lookup(self, fingerprint):
+        """
+        :param fingerprint: ``int`` a hash
+        :return: ``array`` of the window indexes the hash occurs at, in order
+        """
+        first, last = np.searchsorted(self.sorted_hashes, [fingerprint, fingerprint + 1])
+        return self.times[self.order[first:last]]
+
+    #####-----< Voting >-----#####
+    def matches(self, min_lag=1):
+        """ pairs of landmarks sharing a hash, at least min_lag windows apart
+        :return: two-tuple of ``array`` of the earlier landmark (an index into times) of each pair and the lag (in
+        windows) to the later one
+        """
+        earlier, lags = [np.zeros(0, dtype=int)], [np.zeros(0, dtype=int)]
+        # occurrences of a hash are neighbours in the index, and in order, so the first occurrence at least min_lag
+        # after each one is found by a binary search of the keys
+        first = np.searchsorted(self.sorted_keys, self.sorted_keys + min_lag)
+        for k in range(self.MAX_NEIGHBOURS):
+            pair_earlier = np.flatnonzero(first + k < len(self.sorted_keys))
+            pair_later = first[pair_earlier] + k
+            same = self.sorted_hashes[pair_earlier] == self.sorted_hashes[pair_later]
+            pair_earlier, pair_later = self.order[pair_earlier[same]], self.order[pair_later[same]]
+            earlier.append(pair_earlier)
+            lags.append(self.times[pair_later] - self.times[pair_earlier])
+
+        return np.concatenate(earlier), np.concatenate(lags)
+
+    @staticmethod
+    def _offset_votes(offsets, tolerance=2):
+        """
+        :param offsets: ``array`` of ``int`` offsets voted for (possibly negative)
+        :return: two-tuple of the smallest offset and an ``array`` of the votes for each offset from it, where each
+        offset also counts the votes of offsets within tolerance of it
+        """
+        smallest = offsets.min()
+        votes = np.bincount(offsets - smallest).astype(float)
+        return smallest, np.convolve(votes, np.ones(2 * tolerance + 1), mode="same")
+
+    def find_repeated_segment(self, min_seconds, max_seconds):
+        """ find the segment (between min_seconds and max_seconds long) which repeats most strongly
+        :return: ``RepeatedSegment``, or None if nothing repeats
+        """
+        to_windows = lambda seconds: max(int(round(seconds / self.HOP_SECONDS)), 1)
+        min_length, max_length, max_gap = to_windows(min_seconds), to_windows(max_seconds), \
+            to_windows(self.MAX_GAP_SECONDS)
+
+        earlier, lags = self.matches(min_lag=min_length)
+        if len(lags) == 0:
+            return None
+
+        # the longer the lag, the less of the track overlaps itself (and the fewer pairs can vote for it), so votes are
+        # taken relative to the overlap
+        smallest, votes = self._offset_votes(lags)
+        overlap = np.maximum(self.num_windows - (smallest + np.arange(len(votes))), max_length)
+        best_lag = smallest + int(np.argmax(votes / overlap))
+        best_votes = (votes / overlap)[best_lag - smallest]
+
+        # the landmarks matched at the best lag, grouped into segments wherever they're no more than max_gap apart
+        matched = np.zeros(len(self.times), dtype=bool)
+        matched[earlier[np.abs(lags - best_lag) <= 2]] = True
+        matched_landmarks = np.flatnonzero(matched)
+        groups = np.split(matched_landmarks, np.flatnonzero(
+            self.times[matched_landmarks[1:]] - self.ends[matched_landmarks[:-1]] > max_gap) + 1)
+
+        best = max(groups, key=len)
+        # a segment can't overlap its own repeat
+        start = int(self.times[best[0]])
+        end = int(min(self.ends[best].max(), start + max_length, start + best_lag))
+        if end - start < min_length:
+            return None
+
+        # every offset the segment repeats at, in either direction (a landmark in the segment votes for each of its
+        # pairs' offsets)
+        in_segment = (self.times >= start) & (self.times < end)
+        later = np.searchsorted(self.times, self.times[earlier] + lags)
+        offsets = np.concatenate((lags[in_segment[earlier]], -lags[in_segment[later]]))
+        occurrences = [start]
+        if len(offsets):
+            first_offset, offset_votes = self._offset_votes(offsets)
+            threshold = max(self.REPETITION_VOTES * offset_votes.max(), 1)
+            # the strongest offsets are taken first, and an offset closer than a segment's length to one already taken
+            # is the same repeat (or an overlapping one)
+            for i in np.argsort(-offset_votes, kind="mergesort"):
+                if offset_votes[i] < threshold:
+                    break
+                occurrence = start + first_offset + int(i)
+                if all(abs(occurrence - other) >= end - start for other in occurrences):
+                    occurrences.append(occurrence)
+
+        # how far the best lag stands out from a typical lag which was voted for
+        typical = np.median((votes / overlap)[votes > 0])
+        return RepeatedSegment(start=self.seconds(start), end=self.seconds(end), repetitions=len(occurrences),
+                               confidence=float(1 - typical / best_votes),
+                               occurrences=sorted(self.seconds(occurrence) for occurrence in occurrences))
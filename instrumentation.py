@@ -0,0 +1,182 @@
+import contextlib
+import threading
+import logging
+import resource
+import sys
+import time
+
+try:
+    from time import process_time as cpu_time
+except ImportError:
+    from time import clock as cpu_time
+
+
+# the library logs through children of this logger and is silent unless the application configures logging
+logging.getLogger("pychorus").addHandler(logging.NullHandler())
+
+
+class StageRecord(object):
+    """ the measurements of a single run of a stage """
+    __slots__ = ("name", "track", "wall_time", "cpu_time", "samples", "peak_memory")
+
+    def __init__(self, name=None, track=None, wall_time=0.0, cpu_time=0.0, samples=None, peak_memory=None):
+        """
+        :param name: ``str`` the stage which ran (see Instrumentation)
+        :param track: the label of the track being analysed when the stage ran (see Instrumentation.track), or None
+        :param wall_time: ``float`` the number of seconds the stage took
+        :param cpu_time: ``float`` the number of seconds of cpu time used by the process while the stage ran
+        :param samples: ``int`` the number of samples the stage worked through
+        :param peak_memory: ``int`` the peak memory (in bytes) used by the process by the time the stage finished
+        """
+        self.name = name
+        self.track = track
+        self.wall_time = wall_time
+        self.cpu_time = cpu_time
+        self.samples = samples
+        self.peak_memory = peak_memory
+
+    def to_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    def __repr__(self):
+        return "{name}: {wall:.3f}s wall {cpu:.3f}s cpu ({samples} samples)".format(
+            name=self.name, wall=self.wall_time, cpu=self.cpu_time, samples=self.samples)
+
+
+class Instrumentation(object):
+    """ the hooks the library reports the cost of each stage of an analysis through. Every stage which runs while at
+    least one listener is registered produces a ``StageRecord`` which is passed to each listener. Nothing is measured
+    while there are no listeners. Stages may be nested (the spectral stage usually runs inside detection), so the
+    times of different stages shouldn't be added together
+    """
+    DECODE, FRAMING, SPECTRAL, DETECTION = "decode", "framing", "spectral", "detection"
+    STAGES = (DECODE, FRAMING, SPECTRAL, DETECTION)
+
+    # callables which are given each StageRecord
+    _listeners = []
+    # the label of the track being analysed by each thread
+    _local = threading.local()
+
+    #####-----< Listeners >-----#####
+    @classmethod
+    def add_listener(cls, listener):
+        """
+        :param listener: callable which is given a ``StageRecord`` each time a stage finishes
+        """
+        cls._listeners.append(listener)
+
+    @classmethod
+    def remove_listener(cls, listener):
+        if listener in cls._listeners:
+            cls._listeners.remove(listener)
+
+    #####-----< Measurement >-----#####
+    @staticmethod
+    def peak_memory():
+        """
+        :return: ``int`` the peak resident memory (in bytes) of this process so far
+        """
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # linux reports kilobytes, macOS bytes
+        return peak if sys.platform == "darwin" else peak * 1024
+
+    @classmethod
+    @contextlib.contextmanager
+    def track(cls, label):
+        """ attribute the stages run (by this thread) within the block to the track with the given label """
+        previous = getattr(cls._local, "track", None)
+        cls._local.track = label
+        try:
+            yield
+        finally:
+            cls._local.track = previous
+
+    @classmethod
+    @contextlib.contextmanager
+    def stage(cls, name, samples=None):
+        """ measure the block as a run of the named stage. The record is yielded so that the block can fill in the
+        number of samples once it knows it
+        :param name: ``str`` one of STAGES
+        :param samples: ``int`` the number of samples the stage works through, if known up front
+        """
+        record = StageRecord(name=name, samples=samples)
+        if not cls._listeners:
+            yield record
+            return
+
+        record.track = getattr(cls._local, "track", None)
+        wall_started, cpu_started = time.time(), cpu_time()
+        yield record
+        record.wall_time = time.time() - wall_started
+        record.cpu_time = cpu_time() - cpu_started
+        record.peak_memory = cls.peak_memory()
+
+        for listener in list(cls._listeners):
+            listener(record)
+
+
+class LoggingListener(object):
+    """ a listener which logs every stage record """
+
+    def __init__(self, logger=None, level=logging.INFO):
+        """
+        :param logger: ``logging.Logger`` to log to (defaults to pychorus.instrumentation)
+        :param level: ``int`` the level the records are logged at
+        """
+        self.logger = logger or logging.getLogger("pychorus.instrumentation")
+        self.level = level
+
+    def __call__(self, record):
+        self.logger.log(self.level, "%s%r", "[{}] ".format(record.track) if record.track is not None else "", record)
+
+
+class Profiler(object):
+    """ collects the stage records of every track analysed while it's active, e.g.
+
+        with Profiler() as profiler:
+            with Instrumentation.track(path):
+                PyChorus(path).find_chorus()
+        profiler.dump()
+    """
+
+    def __init__(self):
+        self.records = []
+
+    def __call__(self, record):
+        self.records.append(record)
+
+    def __enter__(self):
+        Instrumentation.add_listener(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        Instrumentation.remove_listener(self)
+
+    def breakdown(self):
+        """
+        :return: ``dict`` keyed by track of ``dict`` keyed by stage of the total wall / cpu time and samples of the
+        stage's runs and the peak memory reached by the end of them
+        """
+        tracks = {}
+        for record in self.records:
+            stages = tracks.setdefault(record.track, {})
+            totals = stages.setdefault(record.name, {"runs": 0, "wall_time": 0.0, "cpu_time": 0.0, "samples": 0,
+                                                     "peak_memory": 0})
+            totals["runs"] += 1
+            totals["wall_time"] += record.wall_time
+            totals["cpu_time"] += record.cpu_time
+            totals["samples"] += record.samples or 0
+            totals["peak_memory"] = max(totals["peak_memory"], record.peak_memory or 0)
+        return tracks
+
+    def dump(self, output=sys.stderr):
+        """ write a table of the per-track breakdown to output """
+        output.write("{:<40} {:<10} {:>5} {:>10} {:>10} {:>12} {:>10}\n".format(
+            "track", "stage", "runs", "wall (s)", "cpu (s)", "samples", "peak (MB)"))
+        for track, stages in sorted(self.breakdown().items(), key=lambda item: str(item[0])):
+            for name in sorted(stages, key=lambda name: Instrumentation.STAGES.index(name)
+                               if name in Instrumentation.STAGES else len(Instrumentation.STAGES)):
+                totals = stages[name]
+                output.write("{:<40} {:<10} {:>5} {:>10.3f} {:>10.3f} {:>12} {:>10.1f}\n".format(
+                    str(track)[-40:], name, totals["runs"], totals["wall_time"], totals["cpu_time"],
+                    totals["samples"], totals["peak_memory"] / float(1 << 20)))
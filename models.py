@@ -1,57 +1,493 @@
-from sound_utils import SoundUtils
+from __future__ import print_function
+from instrumentation import Instrumentation
+from sound_utils import Parallel, SoundUtils
+import logging
 import math
 import numpy as np
 import time
 import pdb
 
+try:
+    from math import gcd
+except ImportError:
+    from fractions import gcd
 
-class Frame(object):
-    """ a frame is an abstraction for a group of samples and can be thought of as a link in a doubly linked list """
-    def __init__(self, samples=None, sample_rate=None, next_frame=None, prev_frame=None, index=0):
+logger = logging.getLogger("pychorus.models")
+
+
+class FrameTable(object):
+    """ a columnar table holding the per-frame data of a Song. Each column is a numpy array indexed by frame, and
+    all of the columns are computed in a single vectorized pass over the song's samples """
+    # the number of samples reduced together (bounds the size of the temporary arrays we create)
+    SAMPLES_PER_BLOCK = 1 << 20
+    # (low, high) bounds (in hz) of the human vocal range, and the extra weight it carries in a frequency score
+    VOCAL_BAND = (300, 3400)
+    VOCAL_WEIGHT = 1.5
+
+    def __init__(self, samples=None, sample_rate=None, frame_length=None, hop_length=None):
         """
         :param samples: ``array`` of samples read from the sound file
-        :param sample_rate: ``int``
-        :param next_frame: ``Frame`` the next frame in the DLL
-        :param prev_frame: ``Frame`` the previous frame in the DLL
-        :param amplitude_score: ``float`` value between 0 and 1 which represents how loud the song is at this point relative
-        to the rest of the song (a value above .5 means the volume is above average at this point)
-        :param index: ``int`` primarily for debugging purpose, this frames index in the song's list of frames
+        :param sample_rate: ``int`` the sampling rate of the samples
+        :param frame_length: ``int`` the number of samples in a Frame (defaults to a second of audio)
+        :param hop_length: ``int`` the number of samples between the starts of consecutive frames (defaults to
+        frame_length, i.e. frames don't overlap)
         """
         self.samples = samples
         self.sample_rate = sample_rate
-        self.next_frame = next_frame
-        self.prev_frame = prev_frame
-        self.index = index
+        frame_length = frame_length or sample_rate
+        hop_length = hop_length or frame_length
+
+        # group the samples into (possibly overlapping) windows. A frame is only started if at least a full frame of
+        # audio follows its start
+        num_frames = max(0, (len(samples) - frame_length + hop_length - 1) // hop_length) if frame_length else 0
+
+        with Instrumentation.stage(Instrumentation.FRAMING, samples=len(samples)):
+            start = np.arange(num_frames) * hop_length
+            self._set_columns(start, start + frame_length, frame_length=frame_length, hop_length=hop_length)
+
+    def _set_columns(self, start, stop, frame_length, hop_length, amplitude=None):
+        """ set up the columns of the table for frames spanning the given sample offsets
+        :param amplitude: ``array`` the average amplitude of each frame, calculated from the samples if not given
+        """
+        self.frame_length = frame_length
+        self.hop_length = hop_length
+        self.index = np.arange(len(start))
+        self.start = start
+        self.stop = stop
+        self.amplitude = self._amplitudes() if amplitude is None else amplitude
+        self.is_crescendo = self._crescendos()
+        self.crescendo_length = RunIndex.run_lengths(self.is_crescendo)
+        # value between 0 and 1 which represents a measure of the frequency dispersion / density of each frame (NaN
+        # until it has been calculated)
+        self.frequency_score = np.full(len(start), np.nan)
+        # whether the spectral features of each frame are calculated (see restrict_to)
+        self.analysed = np.ones(len(start), dtype=bool)
+
+        self._frames = None
+        self._spectra = None
+        self._chroma = None
+
+    @classmethod
+    def from_columns(cls, sample_rate, start, stop, amplitude, frequency_score=None, chroma=None, samples=None,
+                     analysed=None):
+        """ rebuild a table from columns which have already been calculated (e.g. ones read back from a cache), without
+        needing the song's samples
+        :param analysed: ``array`` of ``bool`` whether the spectral features of each frame were calculated (see
+        restrict_to), None if they were calculated for every frame
+        :return: ``FrameTable``
+        """
+        table = cls.__new__(cls)
+        table.samples = samples
+        table.sample_rate = sample_rate
+
+        frame_length = int(stop[0] - start[0]) if len(start) else sample_rate
+        hop_length = int(start[1] - start[0]) if len(start) > 1 else frame_length
+        table._set_columns(start, stop, frame_length, hop_length, amplitude=amplitude)
+
+        if analysed is not None:
+            table.analysed = np.asarray(analysed, dtype=bool)
+        if frequency_score is not None:
+            table.frequency_score[:] = frequency_score
+        table._chroma = chroma
+        return table
+
+    def _amplitudes(self):
+        """ for each frame, get the average (absolute) amplitude of its samples. The samples are summed in blocks whose
+        length divides both the frame and hop lengths, so each sample is only visited once however much frames overlap,
+        and each frame's sum is then the difference of two running totals of the blocks
+        :return: ``array`` of ``float`` the average amplitude of each frame
+        """
+        num_frames = len(self.index)
+        if num_frames == 0:
+            return np.zeros(0)
+
+        block_length = gcd(self.frame_length, self.hop_length)
+        num_blocks = int(self.stop[-1]) // block_length
+        blocks_per_chunk = max(self.SAMPLES_PER_BLOCK // block_length, 1)
+
+        totals = np.zeros(num_blocks + 1)
+
+        def reduce_chunk(chunk_range):
+            first, last = chunk_range
+            chunk = self.samples[first * block_length:last * block_length].reshape(last - first, block_length)
+            totals[first + 1:last + 1] = np.absolute(chunk, dtype=np.float64).sum(axis=1)
+
+        # chunks are reduced in parallel (see Parallel)
+        Parallel.map(reduce_chunk, Parallel.ranges(num_blocks, blocks_per_chunk))
+        np.cumsum(totals, out=totals)
+
+        first_block = self.start // block_length
+        return (totals[first_block + self.frame_length // block_length] - totals[first_block]) / self.frame_length
+
+    def _crescendos(self):
+        """ a frame is a step in a crescendo if it's louder than the frame before it
+        :return: ``array`` of ``bool``
+        """
+        is_crescendo = np.zeros(len(self.index), dtype=bool)
+        is_crescendo[1:] = self.amplitude[1:] > self.amplitude[:-1]
+        return is_crescendo
+
+    def _frequency_scores(self):
+        """ a frame's frequency score is a function of the dispersion of the frequency (i.e. the number of populated
+        buckets), the amplitude in those buckets (relative to the rest of the song), and extra weight is given to
+        frequencies in the human vocals bucket
+        :return: ``array`` of ``float`` values between 0 and 1, one per frame
+        """
+        frequencies, powers = self.power_spectra()
+        scores = np.zeros(len(powers))
+        # frames which weren't analysed have no spectrum, so they're left out of the comparison with the rest
+        powers = powers[self.analysed]
+        if len(powers) == 0:
+            return scores
+
+        density = SoundUtils.spectral_density(powers)
+
+        total_power = np.log10(powers.sum(axis=1) + np.finfo(np.float32).tiny)
+        power_range = total_power.max() - total_power.min()
+        loudness = (total_power - total_power.min()) / power_range if power_range > 0 else np.zeros(len(powers))
+
+        vocals = SoundUtils.band_energies(powers, frequencies, bands=[self.VOCAL_BAND])[:, 0]
+        vocals /= np.maximum(powers.sum(axis=1), np.finfo(np.float32).tiny)
+
+        scores[self.analysed] = (density + loudness + self.VOCAL_WEIGHT * vocals) / (2 + self.VOCAL_WEIGHT)
+        return scores
+
+    #####-----< Public >-----#####
+    def power_spectra(self):
+        """ the power spectrum of every frame, computed with one batched transform the first time it's asked for. Frames
+        which aren't analysed (see restrict_to) aren't transformed, and their spectra are left empty (all zeros)
+        :return: two-tuple of an ``array`` of frequencies (in hz) and an ``array`` of powers with shape (frames, bins)
+        """
+        if self._spectra is None:
+            starts = self.start[self.analysed]
+            with Instrumentation.stage(Instrumentation.SPECTRAL, samples=len(starts) * self.frame_length):
+                frequencies, analysed = SoundUtils.frame_power_spectra(self.samples, self.sample_rate, starts,
+                                                                       self.frame_length)
+            powers = np.zeros((len(self), analysed.shape[1]), dtype=analysed.dtype)
+            powers[self.analysed] = analysed
+            self._spectra = frequencies, powers
+        return self._spectra
+
+    def restrict_to(self, analysed):
+        """ limit the (expensive) spectral features of the table to some of its frames, e.g. the regions of a song which
+        could hold its chorus. Features which were already calculated are thrown away
+        :param analysed: ``array`` of ``bool`` whether the spectral features of each frame should be calculated
+        """
+        self.analysed = np.asarray(analysed, dtype=bool)
+        self.frequency_score[:] = np.nan
+        self._spectra = None
+        self._chroma = None
+
+    @property
+    def skipped_fraction(self):
+        """ the fraction (between 0 and 1) of the table's frames whose spectral features aren't calculated """
+        return 1 - self.analysed.mean() if len(self) else 0.0
+
+    def analysed_spans(self):
+        """
+        :return: two-tuple of ``array`` of the first and last (exclusive) sample offset of each run of analysed frames
+        """
+        starts, stops = RunIndex.runs(self.analysed)
+        return self.start[starts], self.stop[stops - 1]
+
+    def chroma(self):
+        """ the power in each of the 12 pitch classes of every frame, folded from the frames' power spectra
+        :return: float32 ``array`` with shape (frames, 12)
+        """
+        if self._chroma is None:
+            frequencies, powers = self.power_spectra()
+            self._chroma = SoundUtils.chroma(powers, frequencies)
+        return self._chroma
+
+    @classmethod
+    def feature_params(cls):
+        """
+        :return: ``dict`` of the settings the spectral features of a table depend on
+        """
+        return {"n_fft": SoundUtils.N_FFT, "density_floor_db": SoundUtils.DENSITY_FLOOR_DB,
+                "chroma_range": list(SoundUtils.CHROMA_RANGE), "vocal_band": list(cls.VOCAL_BAND),
+                "vocal_weight": cls.VOCAL_WEIGHT}
+
+    def frequency_scores(self):
+        """
+        :return: ``array`` of the frequency score of every frame
+        """
+        if len(self) and np.isnan(self.frequency_score).any():
+            self.frequency_score[:] = self._frequency_scores()
+        return self.frequency_score
+
+    @property
+    def frames(self):
+        """ the ``Frame`` views onto this table. Views are created once so that the same frame is always represented by
+        the same object
+        """
+        if self._frames is None:
+            self._frames = [Frame(table=self, index=i) for i in range(len(self))]
+        return self._frames
+
+    def frame(self, index):
+        """
+        :return: the ``Frame`` at the given index or None if the index is out of bounds
+        """
+        if 0 <= index < len(self):
+            return self.frames[index]
+        return None
+
+    @property
+    def hop_seconds(self):
+        """ the number of seconds between the starts of consecutive frames """
+        return self.hop_length / float(self.sample_rate)
+
+    @property
+    def duration(self):
+        """ get the number of seconds of audio covered by the frames of this table """
+        return self.stop[-1] / float(self.sample_rate) if len(self) else 0.0
 
-        self.value = self._value()
+    def __len__(self):
+        return len(self.index)
 
-        # should be set after all initialization has occurred (including setting prev and next pointers as appropriate)
-        self.is_crescendo = None
-        # value between 0 and 1 which represents a measure of the frequency dispersion / density of this frame
-        self.frequency_score = None
 
-    def _value(self):
-        """ for self.samples, get the average amplitude
-        :return: ``int`` the average amplitude of the samples for this Frame
+class RunIndex(object):
+    """ a run-length index of the loud, quiet and crescendo runs of a song's frames. It's built in a single pass over
+    the frames, after which questions about runs are answered by lookups (or binary searches) instead of walking from
+    frame to frame """
+    def __init__(self, amplitude, is_crescendo, loud_threshold, quiet_threshold):
         """
-        return sum([abs(n) for n in self.samples]) / len(self.samples)
+        :param amplitude: ``array`` the average amplitude of each frame
+        :param is_crescendo: ``array`` of ``bool`` whether each frame is louder than the one before it
+        :param loud_threshold: ``float`` frames at or above this amplitude are loud
+        :param quiet_threshold: ``float`` frames at or below this amplitude are quiet
+        """
+        self.loud_threshold = loud_threshold
+        self.quiet_threshold = quiet_threshold
+
+        self.loud = amplitude >= loud_threshold
+        self.quiet = amplitude <= quiet_threshold
+        self.crescendo = np.asarray(is_crescendo, dtype=bool)
+
+        self.loud_runs = self.runs(self.loud)
+        self.quiet_runs = self.runs(self.quiet)
+        self.crescendo_runs = self.runs(self.crescendo)
+        self.crescendo_length = self.run_lengths(self.crescendo)
+        # the indexes of every frame which isn't loud, in order
+        self.not_loud = np.flatnonzero(~self.loud)
+
+    @staticmethod
+    def runs(mask):
+        """
+        :param mask: ``array`` of ``bool``
+        :return: two-tuple of ``array`` of the start (inclusive) and stop (exclusive) index of each run of True values
+        """
+        edges = np.diff(np.concatenate(([0], np.asarray(mask, dtype=np.int8), [0])))
+        return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+    @staticmethod
+    def run_lengths(mask):
+        """
+        :param mask: ``array`` of ``bool``
+        :return: ``array`` of ``int`` the number of consecutive True values ending at each index (0 where mask is False)
+        """
+        index = np.arange(len(mask))
+        last_false = np.maximum.accumulate(np.where(mask, -1, index)) if len(mask) else index
+        return index - last_false
+
+    def run_containing(self, runs, index):
+        """
+        :param runs: two-tuple of run starts and stops (e.g. self.loud_runs)
+        :return: two-tuple of the start and stop of the run containing index, or None if it's not in a run
+        """
+        starts, stops = runs
+        i = np.searchsorted(starts, index, side="right") - 1
+        if i >= 0 and index < stops[i]:
+            return starts[i], stops[i]
+        return None
+
+    def sustained_spans(self, cushion, minimum_length):
+        """ find the frames covered by sustained loud blocks. Starting at a loud frame, a block carries on until more
+        than cushion frames (not necessarily consecutive) which aren't loud have been seen, and it's sustained if it
+        contains at least minimum_length loud frames. A block also covers the frame after the one which ended it
+        :return: ``array`` of the (sorted, unique) indexes of every frame in a sustained block
+        """
+        num_frames = len(self.loud)
+        starts = np.flatnonzero(self.loud)
+
+        # the index (into not_loud) of the first frame after each start which isn't loud, and of the one ending the block
+        first_quiet = np.searchsorted(self.not_loud, starts)
+        last_quiet = first_quiet + cushion
+        ended = last_quiet < len(self.not_loud)
+
+        ends = np.full(len(starts), num_frames - 1)
+        ends[ended] = self.not_loud[last_quiet[ended]]
+        num_quiet = np.where(ended, cushion + 1, len(self.not_loud) - first_quiet)
+        num_loud = ends - starts + 1 - num_quiet
+
+        sustained = num_loud >= minimum_length
+        stops = np.minimum(ends[sustained] + 1, num_frames - 1) + 1
+
+        # the union of every block, found by marking where blocks start / stop
+        coverage = np.zeros(num_frames + 1, dtype=int)
+        np.add.at(coverage, starts[sustained], 1)
+        np.add.at(coverage, stops, -1)
+        return np.flatnonzero(np.cumsum(coverage)[:num_frames] > 0)
+
+
+class SegmentScorer(object):
+    """ scores every segment of a song's frames from prefix sums (integral arrays) of per-frame columns such as
+    amplitude and frequency score. The sum of any column over any [start, end) window is the difference of two prefix
+    sums, so the mean, variance and contrast of a window are found in constant time, and every window can be scored at
+    once with array arithmetic instead of walking from frame to frame. Each column is scaled by its standard deviation
+    across the song, so the columns are weighed equally and scores are in standard deviations
+    """
+    # how much a window's score is lowered by the spread (standard deviation) of its frames, relative to its contrast
+    SPREAD_PENALTY = .5
+
+    def __init__(self, columns):
+        """
+        :param columns: ``array`` with shape (frames,) or (frames, columns) of the per-frame values segments are scored
+        by (higher values being more chorus like)
+        """
+        columns = np.asarray(columns, dtype=np.float64)
+        # (a song without any frames has a single, empty column)
+        columns = columns.reshape(len(columns), -1) if len(columns) else np.zeros((0, 1))
+        spread = columns.std(axis=0) if len(columns) else np.ones(columns.shape[1])
+        columns = columns / np.where(spread > 0, spread, 1)
+
+        self.num_frames = len(columns)
+        # sums[i] is the total of the first i frames (so sums[0] is 0), and squares likewise for the squared values
+        self.sums = np.zeros((self.num_frames + 1, columns.shape[1]))
+        self.squares = np.zeros((self.num_frames + 1, columns.shape[1]))
+        np.cumsum(columns, axis=0, out=self.sums[1:])
+        np.cumsum(columns ** 2, axis=0, out=self.squares[1:])
+
+    def total(self, starts, ends, prefix=None):
+        """
+        :param starts: ``int`` or ``array`` of the first frame of each window
+        :param ends: ``int`` or ``array`` of the frame after the last one of each window
+        :param prefix: the prefix sums to total (defaults to self.sums)
+        :return: ``array`` with shape (windows, columns) of the total of each column over each window
+        """
+        prefix = self.sums if prefix is None else prefix
+        return prefix[np.asarray(ends)] - prefix[np.asarray(starts)]
 
-    def _is_crescendo(self):
-        """ check whether this Frame represents a step in a crescendo
-        :return: ``bool`` True if this Frame is part of a crescendo, False otherwise
+    def mean(self, starts, ends):
+        """
+        :return: ``array`` with shape (windows, columns) of the mean of each column over each (non empty) window
         """
-        return self.prev_frame is not None and self.prev_frame.value < self.value
+        lengths = np.asarray(ends) - np.asarray(starts)
+        return self.total(starts, ends) / np.maximum(lengths, 1)[..., np.newaxis]
+
+    def variance(self, starts, ends):
+        """
+        :return: ``array`` with shape (windows, columns) of the variance of each column over each (non empty) window
+        """
+        lengths = np.maximum(np.asarray(ends) - np.asarray(starts), 1)[..., np.newaxis]
+        mean = self.total(starts, ends) / lengths
+        return np.maximum(self.total(starts, ends, prefix=self.squares) / lengths - mean ** 2, 0)
+
+    def contrast(self, starts, ends, context=None):
+        """ how much higher each window is than its surroundings: the frames on either side of it, as far as context
+        frames (or the start / end of the song)
+        :param context: ``int`` the number of frames on each side of a window it's compared with (defaults to the
+        window's own length)
+        :return: ``array`` with shape (windows, columns) of the difference of the mean of each column over each window
+        and over its surroundings (0 for a window with no surroundings)
+        """
+        starts, ends = np.asarray(starts), np.asarray(ends)
+        context = ends - starts if context is None else context
+        before, after = np.maximum(starts - context, 0), np.minimum(ends + context, self.num_frames)
+
+        surrounding = (starts - before) + (after - ends)
+        surroundings = (self.total(before, starts) + self.total(ends, after)) / np.maximum(surrounding, 1)[
+            ..., np.newaxis]
+        return np.where((surrounding > 0)[..., np.newaxis], self.mean(starts, ends) - surroundings, 0)
+
+    def score(self, starts, ends, context=None):
+        """ a window's score is its contrast with its surroundings less the spread of its frames, averaged over the
+        columns. The chorus (as a whole) stands out from the verses / bridge around it, whereas a window which only
+        covers part of it is surrounded by the rest, and one which spills over its ends takes in quieter frames
+        :param context: ``int`` see contrast
+        :return: ``array`` of the score of each window
+        """
+        penalty = self.SPREAD_PENALTY * np.sqrt(self.variance(starts, ends))
+        return (self.contrast(starts, ends, context=context) - penalty).mean(axis=-1)
+
+    def best(self, min_length, max_length, context=None):
+        """ exhaustively score every window between min_length and max_length frames long. Windows are scored a length
+        at a time (every start at once), so memory stays proportional to the number of frames
+        :return: three-tuple of the start and end (exclusive) frame of the best window and its score, or (None, None,
+        -inf) if the song is shorter than min_length
+        """
+        best = (None, None, -np.inf)
+        for length in range(max(min_length, 1), min(max_length, self.num_frames) + 1):
+            starts = np.arange(self.num_frames - length + 1)
+            scores = self.score(starts, starts + length, context=context)
+            i = int(np.argmax(scores))
+            if scores[i] > best[2]:
+                best = (i, i + length, float(scores[i]))
+        return best
+
+
+class Frame(object):
+    """ a frame is an abstraction for a group of samples and can be thought of as a link in a doubly linked list. The
+    data for a frame lives in its Song's ``FrameTable``, the Frame itself is only a thin view onto one row of it """
+    __slots__ = ("table", "index")
+
+    def __init__(self, table=None, index=0):
+        """
+        :param table: ``FrameTable`` the table holding this frame's data
+        :param index: ``int`` primarily for debugging purpose, this frames index in the song's list of frames
+        """
+        self.table = table
+        self.index = index
+
+    #####-----< Properties >-----#####
+    @property
+    def samples(self):
+        return self.table.samples[self.table.start[self.index]:self.table.stop[self.index]]
+
+    @property
+    def sample_rate(self):
+        return self.table.sample_rate
+
+    @property
+    def time(self):
+        """ the offset of this frame from the start of the song (in seconds) """
+        return self.table.start[self.index] / float(self.table.sample_rate)
+
+    @property
+    def end_time(self):
+        """ the offset of the end of this frame from the start of the song (in seconds) """
+        return self.table.stop[self.index] / float(self.table.sample_rate)
+
+    @property
+    def value(self):
+        """ the average amplitude of the samples for this Frame """
+        return self.table.amplitude[self.index]
+
+    @property
+    def is_crescendo(self):
+        """ True if this Frame is part of a crescendo, False otherwise """
+        return bool(self.table.is_crescendo[self.index])
+
+    @property
+    def frequency_score(self):
+        score = self.table.frequency_score[self.index]
+        return None if np.isnan(score) else score
+
+    @property
+    def next_frame(self):
+        return self.table.frame(self.index + 1)
+
+    @property
+    def prev_frame(self):
+        return self.table.frame(self.index - 1)
 
     def _frequency_score(self):
         """ this frames frequency score is a function of the dispersion of the frequency (i.e. the number of populated
         buckets), the amplitude in those buckets, and extra weight is given to frequencies in the human vocals bucket
-        :return: ``float`` value between 0 and 1 representing this frame's (unweighted relative to the entire song)
-        frequency score
+        :return: ``float`` value between 0 and 1 representing this frame's frequency score
         """
-        frequency_buckets = SoundUtils.fourier_transform(self.samples, self.sample_rate)
-
-        print "frequency buckets are {}\n\n".format(frequency_buckets)
-
+        return self.table.frequency_scores()[self.index]
 
 
     #####-----< Public >-----#####
@@ -81,18 +517,12 @@ class Frame(object):
         :return: ``int`` the number of frames the crescendo occupies up to self or - if self is not part of
         a crescendo - 0
         """
-        if not self.is_crescendo or not self.prev_frame:
-            return 0
-        else:
-            return 1 + self.prev_frame.get_crescendo_length()
+        return int(self.table.crescendo_length[self.index])
 
 
     #####-----< Setters >-----#####
-    def set_is_crescendo(self):
-        self.is_crescendo = self._is_crescendo()
-
     def set_frequency_score(self):
-        self.frequency_score = self._frequency_score()
+        self.table.frequency_score[self.index] = self._frequency_score()
 
     def __repr__(self):
         return "{val} {cresc}".format(val=self.value, cresc="inc" if self.is_crescendo else "dec")
@@ -102,36 +532,90 @@ class Song(object):
     # standard deviations for what defines a loud / quiet portion of a song
     SD_FOR_QUIET = .5
     SD_FOR_LOUD = .5
-
-    def __init__(self, samples=None, sample_rate=None, debug=False):
-        self.frames = self._create_frames(samples, sample_rate)
+    # standard deviations above the average frequency score for a portion of a song to be considered saturated
+    SD_FOR_SATURATED = 1
+    # the average (cosine) similarity of the chroma of two windows of a song for one to be considered a repeat
+    REPETITION_SIMILARITY = .5
+
+    # how close (in seconds) the end of a bridge has to be to the start of a fingerprinted repeat to be looked at
+    FINGERPRINT_CUSHION = 4
+
+    # the strategies find_chorus_candidates runs, cheapest first
+    CANDIDATE_STRATEGIES = ("_amplitude_candidates", "_bridge_candidates", "_fingerprint_candidates",
+                            "_repetition_candidates")
+    # how far each strategy's evidence is trusted: a candidate's confidence is the strength of its evidence (between 0
+    # and 1) times the reliability of the strategy which found it
+    STRATEGY_RELIABILITY = {"increased amplitude": .5, "bridge reference": .7, "fingerprint": .8, "repetition": .9}
+    # how close (in seconds) the starts of two candidates have to be for them to be considered the same chorus
+    CANDIDATE_CUSHION = 4
+    # how far (in seconds) either side of a window its surroundings stretch when it's scored (see SegmentScorer)
+    SEGMENT_CONTEXT = 8
+
+    # the cascade (see Song.cascade): frames quieter than this fraction of the loudest frame are silent, loud /
+    # crescendo runs less than REGION_GAP_SECONDS apart belong to the same region, and each region is widened by
+    # REGION_MARGIN_SECONDS on either side (so the frames leading into and out of a chorus are analysed too)
+    SILENCE_FLOOR = .02
+    REGION_GAP_SECONDS = 4
+    REGION_MARGIN_SECONDS = 4
+    # the minimum length (in seconds) of a crescendo which could be considered a build up to a chorus
+    BUILDING_BRIDGE_THRESHOLD = 3
+
+    # strategies find_chorus can use: loudness heuristics (the bridge, then sustained loud blocks), repetition,
+    # approximate repetition found by fingerprinting (a fast way of narrowing down where the bridge might end), or the
+    # best scoring window of chorus length (see SegmentScorer)
+    AMPLITUDE, REPETITION, FINGERPRINT, SEGMENT = "amplitude", "repetition", "fingerprint", "segment"
+
+    def __init__(self, samples=None, sample_rate=None, debug=False, table=None, frame_seconds=1.0, hop_seconds=None,
+                 cascade=False):
+        """
+        :param samples: ``array`` of raw samples read from a .wav file
+        :param sample_rate: ``int`` the sampling rate of the .wav audio
+        :param debug: ``bool``
+        :param table: ``FrameTable`` previously calculated frames to use instead of creating them from samples
+        :param frame_seconds: ``float`` the length of a frame
+        :param hop_seconds: ``float`` the time between the starts of consecutive frames (defaults to frame_seconds)
+        :param cascade: ``bool`` whether to only analyse the spectrum of the regions which could hold the chorus (see
+        Song.cascade)
+        """
+        if table is None:
+            table = self._create_frames(samples, sample_rate, frame_seconds=frame_seconds, hop_seconds=hop_seconds)
+        self.table = table
+        self.frames = self.table.frames
         self.debug = debug
+        # the name of the measure the last call to find_chorus located the chorus with (None if it wasn't found)
+        self.chorus_method = None
+        self._runs = None
+        self._fingerprints = None
+        self._segments = None
+
+        if cascade:
+            self.cascade()
 
     #####-----< Init Helpers >-----#####
-    def _create_frames(self, samples, sample_rate):
+    @staticmethod
+    def _create_frames(samples, sample_rate, frame_seconds=1.0, hop_seconds=None):
         """ group the given samples into windows which we can more easily work with
         :param samples: ``array`` of raw samples read from a .wav file
         :param sample_rate: ``int`` the sampling rate of the .wav audio
+        :param frame_seconds: ``float`` the length of a frame
+        :param hop_seconds: ``float`` the time between the starts of consecutive frames (defaults to frame_seconds)
+        :return: ``FrameTable`` holding the per-frame data of the song
         """
-        # group the samples into second-intervals (so each Frame represents a second of audio)
-        frames = []
+        frame_length = max(int(round(frame_seconds * sample_rate)), 1)
+        hop_length = max(int(round(hop_seconds * sample_rate)), 1) if hop_seconds else frame_length
+        return FrameTable(samples=samples, sample_rate=sample_rate, frame_length=frame_length, hop_length=hop_length)
 
-        for i in range(0, len(samples) - sample_rate, sample_rate):
-            cur_frame = Frame(samples=samples[i:i + sample_rate], sample_rate=sample_rate, index=(i / sample_rate))
-
-            if len(frames) > 0:
-                # we pop the last frame off the stack in order to set pointers appropriately, then we add it back to
-                # the top of the stack after pointers have been set
-                prev_frame = frames.pop()
-                prev_frame.next_frame = cur_frame
-                frames.append(prev_frame)
-
-                cur_frame.prev_frame = prev_frame
-                cur_frame.set_is_crescendo()
-
-            frames.append(cur_frame)
+    def _frames_in(self, seconds):
+        """
+        :return: ``int`` the (rounded, at least one) number of frames spanning the given number of seconds
+        """
+        return max(int(round(seconds / self.table.hop_seconds)), 1)
 
-        return frames
+    def _frame_at(self, seconds):
+        """
+        :return: ``Frame`` the (last) frame starting at or before the given offset (in seconds) into the song
+        """
+        return self.frames[min(max(int(seconds / self.table.hop_seconds), 0), len(self.frames) - 1)]
 
 
     #####-----< Internals >-----#####
@@ -140,19 +624,14 @@ class Song(object):
             yield i
 
     def __repr__(self):
-        uni = ""
-
-        for f in self:
-            uni += "{} -> ".format(f.value)
-
-        return uni
+        return "".join("{} -> ".format(amplitude) for amplitude in self.table.amplitude)
 
 
     #####-----< Properties >-----#####
     @property
     def length(self):
         """ get the length of this song in seconds """
-        return sum([f.get_num_seconds() for f in self])
+        return self.table.duration
 
     @property
     def min_chorus_length(self):
@@ -163,9 +642,7 @@ class Song(object):
         CHORUSES_OVERALL_PERCENTAGE_OF_SONG = .10
         CHORUS_SONG_PERCENTAGE = CHORUSES_OVERALL_PERCENTAGE_OF_SONG / NUM_CHORUSES
 
-        min_length = int(len(self.frames) * CHORUS_SONG_PERCENTAGE)
-        print "using min chorus length ", min_length
-        return min_length
+        return int(len(self.frames) * CHORUS_SONG_PERCENTAGE)
 
     @property
     def max_chorus_length(self):
@@ -176,13 +653,11 @@ class Song(object):
         CHORUSES_OVERALL_PERCENTAGE_OF_SONG = .40
         CHORUS_SONG_PERCENTAGE = CHORUSES_OVERALL_PERCENTAGE_OF_SONG / NUM_CHORUSES
 
-        max_length = int(len(self.frames) * CHORUS_SONG_PERCENTAGE)
-        print "using max chorus length ", max_length
-        return max_length
+        return int(len(self.frames) * CHORUS_SONG_PERCENTAGE)
 
     @property
     def amplitudes(self):
-        return [f.value for f in self]
+        return self.table.amplitude
 
     @property
     def avg_amplitude(self):
@@ -203,13 +678,41 @@ class Song(object):
         return self.avg_amplitude + (self.std_amplitude * self.SD_FOR_LOUD)
 
 
+    def detection_params(self, method):
+        """
+        :return: ``dict`` of the settings the result of find_chorus depends on (beyond the frames themselves)
+        """
+        return {"method": method, "sd_for_quiet": self.SD_FOR_QUIET, "sd_for_loud": self.SD_FOR_LOUD,
+                "sd_for_saturated": self.SD_FOR_SATURATED, "repetition_similarity": self.REPETITION_SIMILARITY,
+                "fingerprint_cushion": self.FINGERPRINT_CUSHION,
+                "segment_context": self.SEGMENT_CONTEXT, "segment_spread_penalty": SegmentScorer.SPREAD_PENALTY}
+
+
+    @property
+    def runs(self):
+        """ the ``RunIndex`` of this song's loud, quiet and crescendo runs """
+        loud_threshold, quiet_threshold = self.loud_threshold, self.quiet_threshold
+        if self._runs is None or (self._runs.loud_threshold, self._runs.quiet_threshold) != (loud_threshold,
+                                                                                             quiet_threshold):
+            self._runs = RunIndex(self.table.amplitude, self.table.is_crescendo, loud_threshold, quiet_threshold)
+        return self._runs
+
+
+    @property
+    def segments(self):
+        """ the ``SegmentScorer`` of this song's amplitude and frequency scores """
+        if self._segments is None:
+            self._segments = SegmentScorer(np.column_stack((self.table.amplitude, self.table.frequency_scores())))
+        return self._segments
+
+
     #####-----< Helpers >-----#####
     def print_data_in_time(self):
         """ print one Frame of this Song every second
         """
         for el in self:
             time.sleep(1)
-            print el
+            print(el)
 
     def _get_temporal_boundaries(self, frames):
         """ find the temporal boundaries for the given frames. For instance, the given frames might be the frames referenced
@@ -234,73 +737,52 @@ class Song(object):
         """ find points in this Song where the amplitude increases suddenly
         :return: ``list`` of Frame where the amplitude shifts up suddenly
         """
-        print "finding points where amplitudes suddenly increase.."
-
-        result = []
-        crescendo_frames = [f for f in self if f.is_crescendo is True]
-        loud_threshold = self.loud_threshold
-
-        for frame in crescendo_frames:
-            prev_frame = frame.prev_frame
-            if frame.value >= loud_threshold and prev_frame <= self.avg_amplitude:
-                print "sudden increase from {a} to {p}".format(a=frame, p=prev_frame)
-                result.append(frame)
-
-        print "found {} points where amplitude increases suddenly".format(len(result))
+        amplitude = self.table.amplitude
+        sudden = self.runs.crescendo & self.runs.loud
+        # a frame is a sudden increase if it's loud and follows a frame which is no louder than average
+        sudden[1:] &= amplitude[:-1] <= self.avg_amplitude
+        sudden[:1] = False
+        result = [self.frames[i] for i in np.flatnonzero(sudden)]
+
+        logger.debug("found %d points where amplitude increases suddenly", len(result))
         return result
 
     def _find_sustained_amplitude_increases(self):
         """ find points in this Song where the amplitude is sustained for an extended period of time (a more naive
         indicator of a chorus)
+        :return: ``list`` of Frame (in order and without duplicates) which are part of a block of sustained amplitude
         """
-        print "finding points with sustained amplitude increase.."
-
-        result = []
-
-        # the number of sequential frames which are allowed to have a dip in amplitude without triggering a break from
-        # the inner loop
+        # the number of seconds which are allowed to have a dip in amplitude before a block of loud frames is considered
+        # to have ended
         INCONGRUITY_CUSHION = 2
-        # the minimum number of frames which must have am amp increase in order to be considered sustained
+        # the minimum number of seconds which must have am amp increase in order to be considered sustained
         MINIMUM_LENGTH = 10
 
-        loud_threshold = self.loud_threshold
-
-        for frame in self.frames:
-            num_loud_frames = 0
-
-            if frame.value >= loud_threshold:
-                num_loud_frames += 1
+        spans = self.runs.sustained_spans(self._frames_in(INCONGRUITY_CUSHION), self._frames_in(MINIMUM_LENGTH))
+        result = [self.frames[i] for i in spans]
 
-                num_incongruities = 0
-                seq_frame = frame.next_frame
-                while seq_frame and num_incongruities <= INCONGRUITY_CUSHION:
-                    if seq_frame.value >= loud_threshold:
-                        num_loud_frames += 1
-                    else:
-                        num_incongruities += 1
-
-                    seq_frame = seq_frame.next_frame
-
-                if num_loud_frames >= MINIMUM_LENGTH:
-                    result += frame.get_frames_between(seq_frame)
-
-        print "found {} points where amplitude was increased for sustained period".format(len(result))
-        print "points were ", result
+        logger.debug("found %d points where amplitude was increased for sustained period", len(result))
         return result
 
     def _find_saturated_points(self):
         """ search self.samples for points where the frequency spectrum is heavily saturated (as it's likely that these
         are the chorus, since the chorus tends to have many instruments in it).
-        :return: an array of two-tuples which represent points where the frequencies are heavily saturated, relative to
-        most of the song
+        :return: ``list`` of Frame where the frequencies are heavily saturated, relative to most of the song
         """
-        pass
+        scores = self.table.frequency_scores()
+        analysed = scores[self.table.analysed]
+        if len(analysed) == 0:
+            return []
 
-    def _find_bridge_end(self):
+        saturated_threshold = np.average(analysed) + (np.std(analysed) * self.SD_FOR_SATURATED)
+        return [self.frames[i] for i in np.flatnonzero((scores >= saturated_threshold) & self.table.analysed)]
+
+    def _find_bridge_end(self, candidates=None):
         """ if we're able to successfully identify the bridge, we know the chorus is sure to come next. We identify
         the bridge as having both low amplitude, a point where the amplitude quickly increases (when the chorus starts)
         low frequency dispersion, and being towards the end of the song.
 
+        :param candidates: iterable of the indexes of the only frames which may end the bridge (defaults to every frame)
         :return: Frame representing the end of the bridge (and the start of the chorus) if we feel confident we've found
         the bridge, otherwise None
         """
@@ -308,64 +790,216 @@ class Song(object):
 
         # the maximum amount of the song the bridge might occupy
         MAX_BRIDGE_LENGTH = .2
-        # the minimum length of a crescendo which could be considered a build up to a chorus
-        BUILDING_BRIDGE_THRESHOLD = 3
 
         # indicators of chorus
-        sudden_amplitude_increase_points = self._find_sudden_amplitude_increases()
-        saturated_frequency_points = self._find_saturated_points()
-        quiet_threshold = self.quiet_threshold
-        loud_threshold = self.loud_threshold
+        sudden_amplitude_increase_points = set(f.index for f in self._find_sudden_amplitude_increases())
+        runs = self.runs
 
         # the earliest point in the song where the bridge might start (20% from the end plus the length of a chorus)
-        earliest_bridge_start = (MAX_BRIDGE_LENGTH * len(self.frames)) + self.max_chorus_length
-        current_frame_i = len(self.frames) - 1
+        earliest_bridge_start = max(int(math.ceil((MAX_BRIDGE_LENGTH * len(self.frames)) + self.max_chorus_length)), 1)
 
         # we take the end of the bridge to be when the current frame is loud / dense and the previous few frames are
-        # not
-        while bridge_end is None and current_frame_i >= earliest_bridge_start:
-            current_frame = self.frames[current_frame_i]
-            prev_frame = self.frames[current_frame_i - 1]
+        # not. The search runs backwards from the end of the song, so the latest frame which qualifies wins
+        if candidates is None:
+            candidates = range(len(self.frames) - 1, earliest_bridge_start - 1, -1)
+        else:
+            candidates = sorted((i for i in set(candidates) if earliest_bridge_start <= i < len(self.frames)),
+                                reverse=True)
 
+        for current_frame_i in candidates:
             # the more important indicator is amplitude. The type of bridges seem to either be a slow build to a loud chorus
             # or a sudden "drop"
-            if current_frame in sudden_amplitude_increase_points and prev_frame <= quiet_threshold:
-                print "identified the end of the bridge using `sudden amplitude shift` method"
-                bridge_end = current_frame
-            elif current_frame.get_crescendo_length() >= BUILDING_BRIDGE_THRESHOLD and not prev_frame >= loud_threshold:
-                # we check not prev_frame >= loud_threshold to make sure we're not identifying the middle of the chorus as the bridge end
-                print "identified the end of the bridge using `building bridge` method"
-                bridge_end = current_frame
-
-            current_frame_i -= 1
+            if current_frame_i in sudden_amplitude_increase_points and runs.quiet[current_frame_i - 1]:
+                logger.debug("identified the end of the bridge using `sudden amplitude shift` method")
+                bridge_end = self.frames[current_frame_i]
+            elif runs.crescendo_length[current_frame_i] >= self._frames_in(self.BUILDING_BRIDGE_THRESHOLD) and \
+                    not runs.loud[current_frame_i - 1]:
+                # we check the previous frame isn't loud to make sure we're not identifying the middle of the chorus as
+                # the bridge end
+                logger.debug("identified the end of the bridge using `building bridge` method")
+                bridge_end = self.frames[current_frame_i]
+
+            if bridge_end is not None:
+                break
 
         return bridge_end
 
-    def find_chorus(self):
-        """ use amplitude and frequency analysis to guess the location of the chorus start/end.
-        :return: two-tuple containing two Frames, the guessed start and end of the chorus for this Song
+    def _chroma_features(self):
+        """ the chroma of every frame, centered on the song's average chroma and scaled to unit length (so the dot
+        product of two frames' features is their cosine similarity). Frames without any tonal energy get a zero vector
+        so that silence never looks like a repeat
+        :return: float32 ``array`` with shape (frames, 12)
         """
-        print "finding chorus using stats:\nAvg:{avg}\nSTD:{std}\nLow:{low}\nHigh:{high}".format(avg=self.avg_amplitude,
-                                                                                                 std=self.std_amplitude,
-                                                                                                 low=self.quiet_threshold,
-                                                                                                 high=self.loud_threshold)
-        chorus_start = chorus_end = None
-        bridge_end = self._find_bridge_end()
+        chroma = self.table.chroma().copy()
+
+        energy = chroma.sum(axis=1)
+        tonal = energy > .01 * np.median(energy)
+        if not tonal.any():
+            return np.zeros_like(chroma)
+
+        chroma[tonal] /= energy[tonal, np.newaxis]
+        chroma[tonal] -= chroma[tonal].mean(axis=0)
+        chroma[~tonal] = 0
+
+        norms = np.sqrt((chroma ** 2).sum(axis=1))
+        chroma[norms > 0] /= norms[norms > 0, np.newaxis]
+        return chroma
+
+    def _find_repeated_segment(self, deadline=None):
+        """ find the segment of the song (between min_chorus_length and max_chorus_length frames long) which repeats
+        most often, using a time-lag self similarity matrix of the frames' chroma
+        :param deadline: ``float`` the time (as given by time.time) at which the scan for repeats stops early (see
+        SoundUtils.time_lag_repetition)
+        :return: four-tuple containing the first and last Frame of the most repeated segment, the number of times it
+        occurs and its average similarity to its closest repeat, or (None, None, 0, 0.0)
+        """
+        max_length = max(self.max_chorus_length, 1)
+        # windows shorter than a typical chorus repeat by chance too easily, so repeats are found using windows halfway
+        # between the minimum and maximum chorus length
+        window = max((self.min_chorus_length + max_length) // 2, 1)
+        features = self._chroma_features()
+
+        repeats, best, best_lag = SoundUtils.time_lag_repetition(features, window, window, len(features) - window,
+                                                                self.REPETITION_SIMILARITY, deadline=deadline)
+        if len(repeats) == 0 or repeats.max() == 0:
+            return None, None, 0, 0.0
+
+        # the most repeated window wins, ties are broken by how closely the window is repeated
+        end = int(np.argmax(repeats + np.clip(best, -1, 1) / 2.0))
+        start = end - window + 1
+        lag = best_lag[end]
+        # the window and every earlier repeat of it
+        occurrences, closest = int(repeats[end]) + 1, float(best[end])
+
+        # grow the segment in both directions for as long as its frames keep repeating at the same lag. similarity[i] is
+        # the similarity of frame i to frame i - lag, lightly smoothed so a single odd frame doesn't end the segment
+        similarity = np.zeros(len(features), dtype=np.float32)
+        similarity[lag:] = (features[lag:] * features[:-lag]).sum(axis=1)
+        similarity = np.convolve(similarity, np.ones(3) / 3.0, mode="same")
+
+        while end + 1 < len(features) and end - start + 1 < max_length and \
+                similarity[end + 1] >= self.REPETITION_SIMILARITY:
+            end += 1
+        while start - 1 >= lag and end - start + 1 < max_length and similarity[start - 1] >= self.REPETITION_SIMILARITY:
+            start -= 1
+
+        return self.frames[start], self.frames[end], occurrences, closest
 
-        if bridge_end:
-            chorus_start = cur_frame = bridge_end
+    @property
+    def fingerprints(self):
+        """ the ``FingerprintIndex`` of this song's samples, built the first time it's asked for """
+        # fingerprint builds on the models, so it's imported when first needed
+        from fingerprint import FingerprintIndex
+
+        if self._fingerprints is None:
+            if self.table.samples is None:
+                raise ValueError("fingerprinting needs the song's samples, which a table rebuilt from a cache lacks")
+            self._fingerprints = FingerprintIndex(self.table.samples, self.table.sample_rate,
+                                                  spans=self.table.analysed_spans())
+        return self._fingerprints
+
+    def _fingerprinted_segment(self):
+        """
+        :return: ``RepeatedSegment`` (in seconds) the segment of chorus length which repeats most strongly according to
+        the song's fingerprints, or None
+        """
+        hop_seconds = self.table.hop_seconds
+        return self.fingerprints.find_repeated_segment(self.min_chorus_length * hop_seconds,
+                                                       max(self.max_chorus_length, 1) * hop_seconds)
+
+    def find_repeated_segment(self):
+        """ an approximate (but roughly linear time) alternative to the REPETITION strategy, matching fingerprints of
+        the song's spectrum against each other rather than comparing every pair of frames
+        :return: four-tuple containing the first and last Frame of the segment which repeats most strongly, the number
+        of times it occurs and the confidence (between 0 and 1) of the match, or (None, None, 0, 0.0)
+        """
+        segment = self._fingerprinted_segment()
+        if segment is None:
+            return None, None, 0, 0.0
+
+        chorus_start = self._frame_at(segment.start)
+        chorus_end = self.frames[max(self._frame_at(segment.end).index - 1, chorus_start.index)]
+        return chorus_start, chorus_end, segment.repetitions, segment.confidence
+
+    def find_best_segment(self):
+        """ score every window between min_chorus_length and max_chorus_length frames long by how much louder and more
+        saturated it is than its surroundings (see SegmentScorer)
+        :return: three-tuple containing the first and last Frame of the best window and its score, or (None, None, None)
+        """
+        start, end, score = self.segments.best(self.min_chorus_length, max(self.max_chorus_length, 1),
+                                               context=self._frames_in(self.SEGMENT_CONTEXT))
+        if start is None:
+            return None, None, None
+        return self.frames[start], self.frames[end - 1], score
 
-            std_dev = self.std_amplitude
-            avg_amp = self.avg_amplitude
-            # the amplitude threshold is 1 standard deviation below the average
-            amp_threshold = avg_amp - std_dev
+    def chorus_times(self, chorus_start, chorus_end):
+        """
+        :param chorus_start: ``Frame`` the start of the chorus (as found by find_chorus), or None
+        :param chorus_end: ``Frame`` the end of the chorus, or None
+        :return: two-tuple of the start and end (in seconds) of the chorus spanning the given frames, or (None, None)
+        """
+        if chorus_start is None:
+            return None, None
+        # the bridge measure leaves the end empty when the chorus runs to the end of the song
+        return chorus_start.time, chorus_end.end_time if chorus_end else self.length
 
-            # we say that the chorus continues until the frames drop to 1 standard deviation below the norm
-            while cur_frame is not None and cur_frame.value > amp_threshold:
-                cur_frame = cur_frame.next_frame
+    def _chorus_end_after(self, chorus_start):
+        """
+        :return: Frame where the chorus starting at chorus_start ends, or None if it runs to the end of the song
+        """
+        cur_frame = chorus_start
+
+        std_dev = self.std_amplitude
+        avg_amp = self.avg_amplitude
+        # the amplitude threshold is 1 standard deviation below the average
+        amp_threshold = avg_amp - std_dev
+
+        # we say that the chorus continues until the frames drop to 1 standard deviation below the norm
+        while cur_frame is not None and cur_frame.value > amp_threshold:
+            cur_frame = cur_frame.next_frame
+
+        return cur_frame
+
+    def _find_chorus(self, method):
+        """ the body of find_chorus """
+        self.chorus_method = None
+
+        if method == self.REPETITION:
+            chorus_start, chorus_end, _, _ = self._find_repeated_segment()
+            self.chorus_method = "repetition" if chorus_start else None
+            return chorus_start, chorus_end
+
+        if method == self.SEGMENT:
+            chorus_start, chorus_end, _ = self.find_best_segment()
+            self.chorus_method = "segment score" if chorus_start else None
+            return chorus_start, chorus_end
+
+        if method == self.FINGERPRINT:
+            segment = self._fingerprinted_segment()
+            if segment is None:
+                return None, None
+
+            # the chorus should start at one of the repeats, so only frames near their starts can end the bridge
+            cushion = self._frames_in(self.FINGERPRINT_CUSHION)
+            candidates = [i for occurrence in segment.occurrences
+                          for i in range(self._frame_at(occurrence).index - cushion,
+                                         self._frame_at(occurrence).index + cushion + 1)]
+            bridge_end = self._find_bridge_end(candidates=candidates)
+            chorus_start = bridge_end or self._frame_at(segment.start)
+            length = self._frames_in(segment.end - segment.start)
+
+            self.chorus_method = "fingerprinted bridge reference" if bridge_end else "fingerprint"
+            return chorus_start, self.frames[min(chorus_start.index + length - 1, len(self.frames) - 1)]
+
+        logger.debug("finding chorus using stats: avg %s std %s low %s high %s", self.avg_amplitude,
+                     self.std_amplitude, self.quiet_threshold, self.loud_threshold)
+        chorus_start = chorus_end = None
+        bridge_end = self._find_bridge_end()
 
-            chorus_end = cur_frame
-            print "found chorus using `bridge reference` measure"
+        if bridge_end:
+            chorus_start = bridge_end
+            chorus_end = self._chorus_end_after(bridge_end)
+            self.chorus_method = "bridge reference"
         else:
             # if we weren't able to find the bridge, then attempt to locate the chorus by simply looking for blocks of the
             # song that have a sustained amplitude
@@ -375,18 +1009,286 @@ class Song(object):
             # up by temporal locality (to isolate a single chorus block)
             if len(increased_amplitude_frames) > 0:
                 frame_boundaries = self._get_temporal_boundaries(increased_amplitude_frames)
-                print "the frame boundaries are ", frame_boundaries
+                logger.debug("the frame boundaries are %s", frame_boundaries)
 
                 chorus_start = increased_amplitude_frames[0]
-                chorus_end = increased_amplitude_frames[frame_boundaries[0]]
+                # with a single block of frames there are no boundaries, and the block runs to its last frame
+                chorus_end = increased_amplitude_frames[frame_boundaries[0] if frame_boundaries else -1]
 
-                print "found chorus using `increased amplitude` measure"
+                self.chorus_method = "increased amplitude"
+
+        return chorus_start, chorus_end
+
+    def find_chorus(self, method=AMPLITUDE):
+        """ use amplitude and frequency analysis to guess the location of the chorus start/end.
+        :param method: the strategy used to find the chorus, AMPLITUDE, REPETITION, FINGERPRINT or SEGMENT
+        :return: two-tuple containing two Frames, the guessed start and end of the chorus for this Song
+        """
+        with Instrumentation.stage(Instrumentation.DETECTION, samples=len(self.table) * self.table.frame_length):
+            chorus_start, chorus_end = self._find_chorus(method)
 
         if chorus_start:
-            print "the number of frames between the calculated frames is ", len(chorus_start.get_frames_between(chorus_end))
+            logger.debug("found chorus using `%s` measure, from frame %d to %s", self.chorus_method,
+                         chorus_start.index, chorus_end.index if chorus_end else "the end of the song")
         else:
-            print "chorus unable to be found"
+            logger.debug("chorus unable to be found")
 
         return chorus_start, chorus_end
 
 
+    #####-----< Cascade >-----#####
+    def candidate_regions(self):
+        """ the first (amplitude only) pass of the cascade: find the regions of the song which could hold the chorus.
+        Leading and trailing silence is trimmed, and a region is a block of loud frames / crescendos building up to them
+        (allowing short dips between them) which lasts at least min_chorus_length frames
+        :return: ``array`` of ``bool`` whether each frame is in a candidate region
+        """
+        amplitude = self.table.amplitude
+        regions = np.zeros(len(amplitude), dtype=bool)
+        if len(amplitude) == 0:
+            return regions
+
+        sound = np.flatnonzero(amplitude > self.SILENCE_FLOOR * amplitude.max())
+        if len(sound) == 0:
+            return regions
+        first, last = sound[0], sound[-1]
+
+        runs = self.runs
+        crescendo_starts, crescendo_stops = runs.crescendo_runs
+        building = crescendo_stops - crescendo_starts >= self._frames_in(self.BUILDING_BRIDGE_THRESHOLD)
+        active = runs.loud.copy()
+        for start, stop in zip(crescendo_starts[building], crescendo_stops[building]):
+            active[start:stop] = True
+        active[:first] = active[last + 1:] = False
+
+        # join runs separated by short gaps into blocks, and keep the blocks long enough to be a chorus
+        starts, stops = RunIndex.runs(active)
+        joined = np.concatenate(([True], starts[1:] - stops[:-1] > self._frames_in(self.REGION_GAP_SECONDS))) \
+            if len(starts) else np.zeros(0, dtype=bool)
+        block_starts = starts[joined]
+        block_stops = stops[np.concatenate((joined[1:], [True]))] if len(starts) else stops
+        long_enough = block_stops - block_starts >= max(self.min_chorus_length, 1)
+
+        margin = self._frames_in(self.REGION_MARGIN_SECONDS)
+        for start, stop in zip(block_starts[long_enough], block_stops[long_enough]):
+            regions[max(start - margin, first):min(stop + margin, last + 1)] = True
+        return regions
+
+    def cascade(self):
+        """ prune the song before its spectrum is analysed: only the frames in candidate regions (see
+        candidate_regions) have their spectral features calculated, as the rest of the song can't be the chorus. If no
+        region is found everything between the leading and trailing silence is analysed, so the spectral strategies
+        still have something to go on
+        :return: ``float`` the fraction (between 0 and 1) of the song's frames which were skipped
+        """
+        regions = self.candidate_regions()
+        if not regions.any():
+            sound = np.flatnonzero(self.table.amplitude > self.SILENCE_FLOOR * self.table.amplitude.max()) \
+                if len(self.table) else []
+            if len(sound):
+                regions[sound[0]:sound[-1] + 1] = True
+
+        self.table.restrict_to(regions)
+        self._fingerprints = None
+        logger.debug("the cascade skipped %.1f%% of the song's frames", 100 * self.table.skipped_fraction)
+        return self.table.skipped_fraction
+
+
+    #####-----< Anytime Search >-----#####
+    def _loudness_contrast(self, start, end):
+        """
+        :return: ``float`` how much louder the frames from start to end (inclusive) are than the song on average, from 0
+        (no louder) to 1 (as loud as the song's loudest frame)
+        """
+        amplitude = self.table.amplitude
+        peak = amplitude.max() - self.avg_amplitude
+        if peak <= 0:
+            return 0.0
+        return float(np.clip((amplitude[start:end + 1].mean() - self.avg_amplitude) / peak, 0, 1))
+
+    def _amplitude_candidates(self, deadline):
+        """ every block of sustained loud frames, scored by how much louder it is than the rest of the song """
+        frames = self._find_sustained_amplitude_increases()
+        starts = [0] + [boundary + 1 for boundary in self._get_temporal_boundaries(frames)]
+        ends = starts[1:] + [len(frames)]
+        for start, end in zip(starts, ends) if frames else []:
+            first, last = frames[start], frames[end - 1]
+            yield ChorusCandidate(first, last, "increased amplitude", self._loudness_contrast(first.index, last.index))
+
+    def _bridge_candidates(self, deadline):
+        """ the chorus following the end of the bridge, scored by how much louder it is than the rest of the song """
+        bridge_end = self._find_bridge_end()
+        if bridge_end:
+            chorus_end = self._chorus_end_after(bridge_end)
+            last = chorus_end.index if chorus_end else len(self.frames) - 1
+            yield ChorusCandidate(bridge_end, chorus_end, "bridge reference",
+                                  self._loudness_contrast(bridge_end.index, last))
+
+    def _fingerprint_candidates(self, deadline):
+        """ the segment which repeats most strongly according to the song's fingerprints, scored by the fraction of its
+        fingerprints which repeat (discounted when it's only found twice) """
+        # a table read back from a cache has no samples to fingerprint
+        if self.table.samples is None:
+            return
+
+        chorus_start, chorus_end, repetitions, confidence = self.find_repeated_segment()
+        if chorus_start:
+            yield ChorusCandidate(chorus_start, chorus_end, "fingerprint",
+                                  confidence * min((repetitions - 1) / 2.0, 1))
+
+    def _repetition_candidates(self, deadline):
+        """ the segment which repeats most often in the song's chroma, scored by how closely it's repeated (discounted
+        when it's only found twice) """
+        chorus_start, chorus_end, occurrences, closest = self._find_repeated_segment(deadline=deadline)
+        if chorus_start:
+            yield ChorusCandidate(chorus_start, chorus_end, "repetition",
+                                  float(np.clip(closest, 0, 1)) * min((occurrences - 1) / 2.0, 1))
+
+    def _add_candidate(self, pool, candidate):
+        """ add a candidate to the pool. A candidate starting close to one already in the pool is merged with it, the
+        more confident of the two is kept and its confidence is raised by the agreement of the other
+        """
+        candidate.confidence *= self.STRATEGY_RELIABILITY[candidate.strategy]
+        cushion = self._frames_in(self.CANDIDATE_CUSHION)
+
+        for i, other in enumerate(pool):
+            if abs(other.start.index - candidate.start.index) <= cushion:
+                best = other if other.confidence >= candidate.confidence else candidate
+                best.confidence = 1 - (1 - other.confidence) * (1 - candidate.confidence)
+                pool[i] = best
+                return
+        pool.append(candidate)
+
+    def find_chorus_candidates(self, deadline=None, top_k=3):
+        """ an "anytime" alternative to find_chorus for when an answer is needed within a latency budget. Every strategy
+        is run - cheapest first - until the deadline passes, and the candidates they find are pooled and ranked by
+        confidence (rather than stopping at the first strategy which finds a chorus). The repetition scan stops early
+        if the deadline passes while it's running, but other strategies always run to completion once started
+        :param deadline: ``float`` the number of seconds the search may take, None for no limit
+        :param top_k: ``int`` the maximum number of candidates returned
+        :return: ``list`` of the most confident ``ChorusCandidate``, most confident first (empty if nothing was found in
+        time)
+        """
+        stop_at = time.time() + deadline if deadline is not None else None
+        pool = []
+
+        with Instrumentation.stage(Instrumentation.DETECTION, samples=len(self.table) * self.table.frame_length):
+            for strategy in self.CANDIDATE_STRATEGIES:
+                if stop_at is not None and time.time() >= stop_at:
+                    logger.debug("the deadline passed before the `%s` strategy could run", strategy)
+                    break
+                for candidate in getattr(self, strategy)(stop_at):
+                    self._add_candidate(pool, candidate)
+
+        pool.sort(key=lambda candidate: -candidate.confidence)
+        return pool[:top_k]
+
+
+class ChorusCandidate(object):
+    """ a possible location of the chorus found by Song.find_chorus_candidates """
+    __slots__ = ("start", "end", "strategy", "confidence")
+
+    def __init__(self, start=None, end=None, strategy=None, confidence=0.0):
+        """
+        :param start: ``Frame`` the first frame of the chorus
+        :param end: ``Frame`` the last frame of the chorus, None if it runs to the end of the song
+        :param strategy: ``str`` the name of the strategy which found the chorus
+        :param confidence: ``float`` between 0 and 1
+        """
+        self.start = start
+        self.end = end
+        self.strategy = strategy
+        self.confidence = confidence
+
+    def __repr__(self):
+        return "{start} - {end} ({strategy}, {confidence:.2f})".format(
+            start=self.start.index, end=self.end.index if self.end else "end", strategy=self.strategy,
+            confidence=self.confidence)
+
+
+class FramePyramid(object):
+    """ a coarse-to-fine search for the chorus. The chorus is first found using long (cheap) frames over the whole song,
+    then each of its boundaries is refined using short frames covering only the coarse frames either side of it, so
+    the boundaries are as accurate as the short frames without paying for short frames across the whole song """
+    # the number of fine frames averaged either side of a candidate boundary when refining it
+    REFINE_CONTEXT = 4
+
+    def __init__(self, samples=None, sample_rate=None, coarse_seconds=2.0, fine_seconds=.05, debug=False, song=None):
+        """
+        :param samples: ``array`` of raw samples read from a .wav file
+        :param sample_rate: ``int`` the sampling rate of the .wav audio
+        :param coarse_seconds: ``float`` the length of the frames the chorus is first found with
+        :param fine_seconds: ``float`` the length of the frames the boundaries are refined with
+        :param debug: ``bool``
+        :param song: ``Song`` already analysed to use as the coarse frames (its samples and frame length are used
+        instead of samples, sample_rate and coarse_seconds)
+        """
+        if song is None:
+            song = Song(samples=samples, sample_rate=sample_rate, debug=debug, frame_seconds=coarse_seconds)
+        self.coarse = song
+        self.samples = song.table.samples
+        self.sample_rate = song.table.sample_rate
+        self.coarse_seconds = song.table.frame_length / float(song.table.sample_rate)
+        self.fine_seconds = fine_seconds
+
+    @property
+    def length(self):
+        """ the length of the song in seconds (including the end of it which is too short to fill a coarse frame) """
+        return len(self.samples) / float(self.sample_rate)
+
+    def _refine(self, seconds, rising):
+        """ find the sharpest change in amplitude within a coarse frame of seconds. The song is taken to be surrounded by
+        silence, so a chorus which runs to the start / end of the song is refined to it
+        :param rising: ``bool`` True to look for the sharpest increase (the start of a chorus), False for the sharpest
+        decrease (the end of one)
+        :return: ``float`` the refined boundary (in seconds)
+        """
+        first = max(int((seconds - self.coarse_seconds) * self.sample_rate), 0)
+        last = min(int((seconds + self.coarse_seconds) * self.sample_rate), len(self.samples))
+        fine_length = max(int(round(self.fine_seconds * self.sample_rate)), 1)
+
+        table = FrameTable(samples=self.samples[first:last], sample_rate=self.sample_rate, frame_length=fine_length)
+        context = self.REFINE_CONTEXT
+        # the boundary (in seconds) before each fine frame, and after the last one
+        times = np.append(first + table.start, first + len(table) * fine_length) / float(self.sample_rate)
+        amplitude = table.amplitude
+        if last == len(self.samples):
+            amplitude = np.append(amplitude, np.zeros(context))
+            # the last few samples may not fill a fine frame, but the song ends after them
+            times[-1] = self.length
+        if first == 0:
+            amplitude = np.append(np.zeros(context), amplitude)
+            times = np.append(np.zeros(context), times)
+        if len(amplitude) < 2 * context:
+            return seconds
+
+        # the change in the average amplitude from the context frames before each boundary to the ones after it
+        totals = np.concatenate(([0], np.cumsum(amplitude)))
+        boundaries = np.arange(context, len(amplitude) - context + 1)
+        change = (totals[boundaries + context] - 2 * totals[boundaries] + totals[boundaries - context]) / context
+
+        best = boundaries[np.argmax(change) if rising else np.argmin(change)]
+        return float(times[min(best, len(times) - 1)])
+
+    def find_chorus(self, method=Song.AMPLITUDE):
+        """ find the chorus on the coarse frames, then refine its boundaries on fine ones
+        :param method: the strategy used to find the chorus (see Song.find_chorus)
+        :return: two-tuple of the start and end (in seconds) of the chorus, or (None, None)
+        """
+        return self.refine(*self.coarse.find_chorus(method=method))
+
+    def refine(self, chorus_start, chorus_end):
+        """
+        :param chorus_start: ``Frame`` the coarse frame the chorus starts in (as found by Song.find_chorus), or None
+        :param chorus_end: ``Frame`` the coarse frame the chorus ends in, or None if it runs to the end of the song
+        :return: two-tuple of the refined start and end (in seconds) of the chorus, or (None, None)
+        """
+        if not chorus_start:
+            return None, None
+
+        start, end = self.coarse.chorus_times(chorus_start, chorus_end)
+        start = self._refine(start, rising=True)
+        # a chorus the coarse frames have running to the end of the song runs to the very end of it (beyond the last
+        # coarse frame)
+        end = self._refine(end, rising=False) if chorus_end else self.length
+        return start, max(start, end)
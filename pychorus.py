@@ -1,48 +1,183 @@
+from __future__ import print_function
+from decoders import DECODERS
 from file_utils import FileUtils
+from instrumentation import Instrumentation, LoggingListener, Profiler
 from sound_utils import SoundUtils
-from models import Song
+from models import FramePyramid, FrameTable, Song
+import logging
 import time
 import pdb
+import argparse
 import math
 import sys
 
+logger = logging.getLogger("pychorus")
+
 
 class PyChorus(object):
-    def __init__(self, path=None, output_path=None, debug=False):
-        self.file = FileUtils(path)
+    def __init__(self, path=None, output_path=None, debug=False, cache=None, frame_seconds=1.0, hop_seconds=None,
+                 analysis_rate=None, decoder=None, cascade=False, fine_seconds=None):
+        """
+        :param path: ``str`` path to the song
+        :param output_path: ``str`` where write_chorus writes the chorus
+        :param debug: ``bool``
+        :param cache: ``FeatureCache`` used to skip decoding / analysing songs which have been analysed before
+        :param frame_seconds: ``float`` the length of the frames the song is analysed in
+        :param hop_seconds: ``float`` the time between the starts of consecutive frames (defaults to frame_seconds)
+        :param analysis_rate: ``int`` the sampling rate (in hz) the song is analysed at, None for its own rate (see
+        FileUtils)
+        :param decoder: ``str`` the name of the decoder the song is read with, None for the best one available (see
+        FileUtils)
+        :param cascade: ``bool`` whether to only analyse the spectrum of the regions of the song which could hold the
+        chorus (see Song.cascade)
+        :param fine_seconds: ``float`` the length of the frames the boundaries of the chorus are refined with (see
+        FramePyramid), None to leave them on the song's frames
+        """
+        self.path = path
+        self.file = FileUtils(path, analysis_rate=analysis_rate, decoder=decoder)
         self.output_path = output_path
         self.debug = debug
+        self.cache = cache
+        self.fine_seconds = fine_seconds
+        # decoders don't agree on the exact samples of a file (e.g. how much padding an mp3 has), so the decoder is part
+        # of the features' key
+        self.feature_params = dict(FrameTable.feature_params(), frame_seconds=frame_seconds, hop_seconds=hop_seconds,
+                                   analysis_rate=analysis_rate, cascade=cascade,
+                                   decoder=self.file.decoders()[0].NAME)
 
-        rate, data = self.file.get_file_data()
-        self.song = Song(samples=data, sample_rate=rate, debug=self.debug)
+        table = self.cache.load_table(path, self.feature_params) if self.cache else None
+        if table is None:
+            rate, data = self.file.get_file_data()
+            # the preferred decoder may have failed, in which case the features are those of the one which didn't
+            self.feature_params["decoder"] = self.file.decoded_with
+            self.song = Song(samples=data, sample_rate=rate, debug=self.debug, frame_seconds=frame_seconds,
+                             hop_seconds=hop_seconds, cascade=cascade)
+            if self.cache:
+                self.cache.store_table(path, self.feature_params, self.song.table)
+        else:
+            self.song = Song(table=table, debug=self.debug)
 
-        print "song is {}".format(str(self.song))
+        logger.debug("song is %s", self.song)
 
-    def find_chorus(self):
-        return self.song.find_chorus()
+    def find_chorus(self, method=Song.AMPLITUDE):
+        """
+        :param method: the strategy the song should use to find the chorus (see Song.find_chorus)
+        :return: two-tuple containing two Frames, the guessed start and end of the chorus
+        """
+        if not self.cache:
+            return self.song.find_chorus(method=method)
 
-    def write_chorus(self):
-        """ write the calculated chorus to self.output_path
-        :return: True if the chorus was able to be written False otherwise
+        params = dict(self.feature_params, **self.song.detection_params(method))
+        result = self.cache.load_result(self.path, params)
+        if result is not None:
+            self.song.chorus_method = result["method"]
+            return tuple(None if i is None else self.song.frames[i] for i in (result["start"], result["end"]))
+
+        if method == Song.FINGERPRINT:
+            # fingerprinting needs the song's samples
+            self._load_samples()
+
+        chorus_start, chorus_end = self.song.find_chorus(method=method)
+        self.cache.store_result(self.path, params, {
+            "start": chorus_start.index if chorus_start else None,
+            "end": chorus_end.index if chorus_end else None,
+            "method": self.song.chorus_method,
+        })
+        return chorus_start, chorus_end
+
+    def _load_samples(self):
+        """ decode the song's samples if its table was read back from the cache (which doesn't keep them) """
+        if self.song.table.samples is None:
+            self.song.table.samples = self.file.get_file_data()[1]
+
+    def chorus_times(self, method=Song.AMPLITUDE):
         """
-        chorus_start, chorus_stop = self.find_chorus()
+        :param method: the strategy the song should use to find the chorus (see Song.find_chorus)
+        :return: two-tuple of the start and end (in seconds) of the chorus - refined on frames fine_seconds long if
+        they were given - or (None, None)
+        """
+        chorus_start, chorus_end = self.find_chorus(method=method)
+        if not self.fine_seconds:
+            return self.song.chorus_times(chorus_start, chorus_end)
 
-        print "calculated chorus was {start} to {stop}".format(start=chorus_start, stop=chorus_stop)
+        self._load_samples()
+        return FramePyramid(song=self.song, fine_seconds=self.fine_seconds).refine(chorus_start, chorus_end)
 
-        if chorus_start and chorus_stop:
-            if self.debug:
-                print "chorus timing was {start} to {stop}".format(start=chorus_start.index, stop=chorus_stop.index)
+    def write_chorus(self, output_path=None, fade_in=0, fade_out=0, method=Song.AMPLITUDE):
+        """ write the calculated chorus to output_path (or self.output_path). The chorus is cut straight out of the
+        original file rather than re-encoding the whole song (see FileUtils.write_segments)
+        :param fade_in: ``float`` the number of seconds to fade the chorus in over
+        :param fade_out: ``float`` the number of seconds to fade the chorus out over
+        :return: True if the chorus was able to be written False otherwise
+        """
+        output_path = output_path or self.output_path
+        start, end = self.chorus_times(method=method)
+
+        if start is not None:
+            logger.debug("chorus timing was %s to %s", start, end)
+            if output_path:
+                self.file.write_segment(start, end, output_path, fade_in=fade_in, fade_out=fade_out)
             return True
         else:
             return False
 
+    def write_clips(self, clips, fade_in=0, fade_out=0):
+        """ write many clips of this song (e.g. previews), reusing a single mapping of the file for .wav songs
+        :param clips: ``list`` of three-tuples of the start and end of a clip (in seconds) and the path to write it to
+        """
+        self.file.write_segments(clips, fade_in=fade_in, fade_out=fade_out)
+
 
 if __name__ == "__main__":
-    path = sys.argv[1]
+    parser = argparse.ArgumentParser(description="find the chorus of a song")
+    parser.add_argument("path", help="the song to analyse or - with --batch - a directory, glob or manifest file")
+    parser.add_argument("--batch", action="store_true",
+                        help="analyse every file in path on a pool of processes, writing one JSON line per file")
+    parser.add_argument("--jobs", type=int, default=None, help="the number of worker processes (default: all cores)")
+    parser.add_argument("--timeout", type=float, default=None, help="the maximum number of seconds per file")
+    parser.add_argument("--memory-limit", type=int, default=None, help="the maximum memory (in MB) of each worker")
+    parser.add_argument("--method", choices=[Song.AMPLITUDE, Song.REPETITION, Song.FINGERPRINT, Song.SEGMENT],
+                        default=Song.AMPLITUDE,
+                        help="the strategy used to find the chorus")
+    parser.add_argument("--analysis-rate", type=int, default=None,
+                        help="the sampling rate (in hz) to analyse at, e.g. 11025 (default: the file's own rate)")
+    parser.add_argument("--decoder", choices=[decoder.NAME for decoder in DECODERS], default=None,
+                        help="the decoder to read files with (default: the fastest one installed, then ffmpeg)")
+    parser.add_argument("--cascade", action="store_true",
+                        help="only analyse the spectrum of the loud regions which could hold the chorus")
+    parser.add_argument("--refine", type=float, default=None, metavar="SECONDS",
+                        help="refine the chorus boundaries with frames this long, e.g. 0.05")
+    parser.add_argument("--output", default=None, help="where to write the chorus")
+    parser.add_argument("--fade-in", type=float, default=0, help="seconds to fade the written chorus in over")
+    parser.add_argument("--fade-out", type=float, default=0, help="seconds to fade the written chorus out over")
+    parser.add_argument("--verbose", action="store_true", help="log the progress of the analysis to stderr")
+    parser.add_argument("--profile", action="store_true",
+                        help="report the time / memory used by each stage of the analysis (per file with --batch)")
+    args = parser.parse_args()
+
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG, format="%(name)s: %(message)s")
+        Instrumentation.add_listener(LoggingListener())
+
+    if args.batch:
+        from batch import run_batch
+
+        memory_limit = args.memory_limit * 1024 * 1024 if args.memory_limit else None
+        failures = run_batch(args.path, jobs=args.jobs, timeout=args.timeout, memory_limit=memory_limit,
+                             method=args.method, profile=args.profile, analysis_rate=args.analysis_rate,
+                             decoder=args.decoder, cascade=args.cascade)
+        sys.exit(1 if failures else 0)
+
+    with Profiler() as profiler, Instrumentation.track(args.path):
+        succeeded = PyChorus(path=args.path, output_path=args.output, debug=True,
+                             analysis_rate=args.analysis_rate, decoder=args.decoder, cascade=args.cascade,
+                             fine_seconds=args.refine).write_chorus(
+            fade_in=args.fade_in, fade_out=args.fade_out, method=args.method)
 
-    succeeded = PyChorus(path=path, debug=True).write_chorus()
+    if args.profile:
+        profiler.dump()
 
     if succeeded:
-        print "chorus writing succeeded"
+        print("chorus writing succeeded")
     else:
-        print "chorus writing failed"
\ No newline at end of file
+        print("chorus writing failed")
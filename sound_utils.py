@@ -1,37 +1,382 @@
-from numpy.fft import fft
+from multiprocessing.pool import ThreadPool
+from numpy.fft import rfft
+from numpy.lib.stride_tricks import as_strided
+import multiprocessing
+import threading
+import logging
 import pdb
 import numpy as np
 import math
+import time
+import os
+
+logger = logging.getLogger("pychorus.sound_utils")
+
+
+class Parallel(object):
+    """ runs the chunks of a computation over a song's samples on a shared pool of threads. numpy releases the GIL for
+    ffts and for most operations on large arrays, so the chunks run on separate cores. Each chunk writes its results
+    into its own slice of a preallocated output, so the results are stitched together in order whatever order the
+    chunks finish in
+    """
+    # the number of threads the chunks are spread across, None for one per core. 1 runs every chunk in the calling
+    # thread (e.g. when songs are already being analysed in parallel by separate processes)
+    WORKERS = None
+
+    # the pool of each process (a forked child can't use its parent's threads)
+    _pools = {}
+    _lock = threading.Lock()
+    # marks the pool's own threads, so a chunk which itself splits its work runs it in place rather than waiting on
+    # threads which may all be busy
+    _local = threading.local()
+
+    @classmethod
+    def num_workers(cls):
+        return cls.WORKERS or multiprocessing.cpu_count()
+
+    @classmethod
+    def _pool(cls):
+        key = (os.getpid(), cls.num_workers())
+        with cls._lock:
+            if key not in cls._pools:
+                cls._pools[key] = ThreadPool(cls.num_workers(), initializer=cls._mark_worker)
+            return cls._pools[key]
+
+    @classmethod
+    def _mark_worker(cls):
+        cls._local.in_pool = True
+
+    @classmethod
+    def map(cls, function, chunks):
+        """ call function on every chunk
+        :param chunks: ``list`` of the arguments of each call
+        :return: ``list`` of the results of each call, in the order of chunks
+        """
+        if cls.num_workers() <= 1 or len(chunks) <= 1 or getattr(cls._local, "in_pool", False):
+            return [function(chunk) for chunk in chunks]
+        return cls._pool().map(function, chunks, chunksize=1)
+
+    @staticmethod
+    def ranges(length, chunk_length):
+        """
+        :return: ``list`` of two-tuples of the (start, stop) of consecutive chunks of up to chunk_length covering length
+        """
+        return [(first, min(first + chunk_length, length)) for first in range(0, length, chunk_length)]
 
 
 class SoundUtils(object):
+    # the number of windows transformed by a single batched fft call (bounds the memory used by a transform)
+    WINDOWS_PER_BATCH = 256
+    # the default fft size used when analysing the spectrum of a song
+    N_FFT = 4096
+    # (low, high) bounds (in hz) of the bands band_energies reports on by default
+    BANDS = ((20, 250), (250, 2000), (2000, 6000), (6000, 20000))
+    # a bin is considered populated if its power is within this many db of the loudest bin in its window
+    DENSITY_FLOOR_DB = 40
+    # the range of frequencies (in hz) which contribute to chroma features
+    CHROMA_RANGE = (55, 5000)
+    # the number of lags / times whose similarities are computed together by time_lag_repetition
+    LAGS_PER_TILE = 64
+    TIMES_PER_TILE = 512
+    # the number of taps of a decimation filter per unit of the decimation factor (longer filters roll off faster)
+    TAPS_PER_FACTOR = 16
+
     @staticmethod
-    def fourier_transform(samples, sample_rate):
+    def _one_sided_powers(transform, n):
+        """ convert a batch of real ffts into one sided power spectra
+        :param transform: ``array`` of complex fft coefficients with shape (windows, n / 2 + 1)
+        :param n: ``int`` the number of points each fft was taken over
+        :return: ``array`` of float32 powers, the same shape as transform
+        """
+        powers = np.abs(transform).astype(np.float32)
+        powers /= n
+        powers **= 2
+
+        # every bin but DC (and - for an even number of points - nyquist) also holds the power of its negative twin
+        last = powers.shape[1] if n % 2 > 0 else powers.shape[1] - 1
+        powers[:, 1:last] *= 2
+        return powers
+
+    @classmethod
+    def stft(cls, samples, sample_rate, n_fft=N_FFT, hop_length=None, starts=None, window="hann"):
+        """ take a windowed real fft of every window of samples, transforming a batch of windows per call
+        :param samples: ``array`` of samples
+        :param sample_rate: ``int``
+        :param n_fft: ``int`` the number of samples in each window
+        :param hop_length: ``int`` the number of samples between the starts of consecutive windows (defaults to n_fft)
+        :param starts: ``array`` of ``int`` explicit window start offsets, used instead of hop_length if given
+        :param window: "hann" or None for a rectangular window
+        :return: two-tuple of an ``array`` of the frequencies (in hz) of each bin and a float32 ``array`` of powers with
+        shape (windows, bins)
+        """
+        samples = np.asarray(samples)
+        frequencies = np.fft.rfftfreq(n_fft, 1.0 / sample_rate)
+        taper = np.hanning(n_fft).astype(np.float32) if window == "hann" else None
+
+        if starts is None:
+            hop_length = hop_length or n_fft
+            num_windows = max(0, (len(samples) - n_fft) // hop_length + 1)
+            windows = as_strided(samples, shape=(num_windows, n_fft),
+                                 strides=(samples.strides[0] * hop_length, samples.strides[0]))
+        else:
+            num_windows = len(starts)
+            offsets = np.arange(n_fft)
+
+        powers = np.empty((num_windows, len(frequencies)), dtype=np.float32)
+
+        def transform(batch_range):
+            first, last = batch_range
+            if starts is None:
+                batch = windows[first:last].astype(np.float32)
+            else:
+                batch = samples[starts[first:last, np.newaxis] + offsets].astype(np.float32)
+
+            if taper is not None:
+                batch *= taper
+            powers[first:last] = cls._one_sided_powers(rfft(batch, axis=1), n_fft)
+
+        # batches are transformed in parallel (see Parallel)
+        Parallel.map(transform, Parallel.ranges(num_windows, cls.WINDOWS_PER_BATCH))
+        return frequencies, powers
+
+    @classmethod
+    def frame_power_spectra(cls, samples, sample_rate, frame_starts, frame_length, n_fft=N_FFT):
+        """ estimate the power spectrum of each frame by averaging the spectra of the windows it's made up of
+        :param frame_starts: ``array`` of ``int`` the sample offset of each frame
+        :param frame_length: ``int`` the number of samples in each frame
+        :param n_fft: ``int`` the largest fft size to use (it's reduced to fit a frame if frames are short)
+        :return: two-tuple of an ``array`` of frequencies (in hz) and a float32 ``array`` with shape (frames, bins)
+        """
+        n_fft = min(n_fft, 2 ** int(math.log(frame_length, 2)))
+        windows_per_frame = frame_length // n_fft
+
+        frame_starts = np.asarray(frame_starts, dtype=np.int64)
+        starts = (frame_starts[:, np.newaxis] + np.arange(windows_per_frame) * n_fft).ravel()
+        frequencies, powers = cls.stft(samples, sample_rate, n_fft=n_fft, starts=starts)
+
+        return frequencies, powers.reshape(len(frame_starts), windows_per_frame, len(frequencies)).mean(axis=1)
+
+    @classmethod
+    def band_energies(cls, powers, frequencies, bands=BANDS):
+        """
+        :param powers: ``array`` of powers with shape (windows, bins)
+        :param frequencies: ``array`` of the frequency (in hz) of each bin
+        :param bands: ``list`` of (low, high) frequency bounds
+        :return: ``array`` with shape (windows, bands) of the total power within each band
+        """
+        energies = np.empty((len(powers), len(bands)), dtype=np.float32)
+        for i, (low, high) in enumerate(bands):
+            in_band = (frequencies >= low) & (frequencies < high)
+            energies[:, i] = powers[:, in_band].sum(axis=1)
+        return energies
+
+    @staticmethod
+    def spectral_flatness(powers):
+        """ the ratio of the geometric to the arithmetic mean of each spectrum. Values near 1 mean the power is spread
+        evenly (noise-like), values near 0 mean it's concentrated in a few bins (tonal)
+        :return: ``array`` of ``float`` with a value between 0 and 1 per window
+        """
+        powers = powers + np.finfo(np.float32).tiny
+        return np.exp(np.log(powers).mean(axis=1)) / powers.mean(axis=1)
+
+    @classmethod
+    def spectral_density(cls, powers, floor_db=DENSITY_FLOOR_DB):
+        """ the fraction of frequency bins which are populated, i.e. within floor_db of the window's loudest bin
+        :return: ``array`` of ``float`` with a value between 0 and 1 per window
+        """
+        floor = powers.max(axis=1, keepdims=True) * (10 ** (-floor_db / 10.0))
+        return ((powers > floor) & (powers > 0)).mean(axis=1)
+
+    @classmethod
+    def chroma(cls, powers, frequencies, reference=440.0):
+        """ fold each spectrum onto the 12 pitch classes of the chromatic scale (C, C#, .. B)
+        :param powers: ``array`` of powers with shape (windows, bins)
+        :param frequencies: ``array`` of the frequency (in hz) of each bin
+        :param reference: ``float`` the frequency (in hz) of A4
+        :return: float32 ``array`` with shape (windows, 12) of the power in each pitch class
+        """
+        low, high = cls.CHROMA_RANGE
+        in_range = (frequencies >= low) & (frequencies <= high)
+
+        # A is 9 semitones above C
+        semitones = np.round(12 * np.log2(frequencies[in_range] / reference)).astype(int) + 9
+        pitch_classes = np.zeros((in_range.sum(), 12), dtype=np.float32)
+        pitch_classes[np.arange(len(semitones)), semitones % 12] = 1
+
+        return np.dot(powers[:, in_range].astype(np.float32), pitch_classes)
+
+    @classmethod
+    def time_lag_repetition(cls, features, window, min_lag, max_lag, threshold, deadline=None):
+        """ scan the time-lag self similarity matrix of features for windows which repeat earlier in the signal. The
+        matrix is computed a float32 tile at a time over the band of lags between min_lag and max_lag, so memory use is
+        bounded by the tile size and the length of the signal rather than its square
+        :param features: ``array`` with shape (times, dimensions) of unit length (or zero) feature vectors
+        :param window: ``int`` the number of consecutive times which must repeat together
+        :param min_lag: ``int`` the smallest lag considered
+        :param max_lag: ``int`` the largest lag considered
+        :param threshold: ``float`` the average (cosine) similarity over a window at which it's considered a repeat
+        :param deadline: ``float`` the time (as given by time.time) after which no more tiles are started, in which
+        case the results only cover the lags scanned so far
+        :return: three-tuple of ``array`` each indexed by the last time of a window: the number of distinct earlier
+        repeats of the window, the best average similarity to any earlier window and the lag of that best window
+        """
+        features = np.asarray(features, dtype=np.float32)
+        num_times = len(features)
+        max_lag = min(max_lag, num_times - window)
+
+        repeats = np.zeros(num_times, dtype=int)
+        best = np.full(num_times, -np.inf, dtype=np.float32)
+        best_lag = np.zeros(num_times, dtype=int)
+        # whether the previous lag repeated at each time, so a repeat spanning neighbouring lags is only counted once
+        prev_above = np.zeros(num_times, dtype=bool)
+
+        for first_lag in range(min_lag, max_lag + 1, cls.LAGS_PER_TILE):
+            if deadline is not None and first_lag > min_lag and time.time() >= deadline:
+                logger.debug("stopped the repetition scan at lag %d of %d", first_lag, max_lag)
+                break
+
+            lags = np.arange(first_lag, min(first_lag + cls.LAGS_PER_TILE, max_lag + 1))
+            similarity = np.zeros((len(lags), num_times), dtype=np.float32)
+
+            for first_time in range(first_lag, num_times, cls.TIMES_PER_TILE):
+                times = np.arange(first_time, min(first_time + cls.TIMES_PER_TILE, num_times))
+                earlier = features[np.maximum(times[np.newaxis, :] - lags[:, np.newaxis], 0)]
+                tile = (earlier * features[times]).sum(axis=2)
+                # times before a lag have no earlier frame to compare against
+                tile[times[np.newaxis, :] < lags[:, np.newaxis]] = 0
+                similarity[:, times] = tile
+
+            # average the similarity over every window, a window only counts if it and its repeat are in the signal
+            cumulative = np.zeros((len(lags), num_times + 1), dtype=np.float64)
+            np.cumsum(similarity, axis=1, out=cumulative[:, 1:])
+            averages = np.full((len(lags), num_times), -np.inf, dtype=np.float32)
+            averages[:, window - 1:] = (cumulative[:, window:] - cumulative[:, :-window]) / window
+            averages[np.arange(num_times)[np.newaxis, :] < (lags + window - 1)[:, np.newaxis]] = -np.inf
+
+            above = averages >= threshold
+            starts_repeat = above.copy()
+            starts_repeat[0] &= ~prev_above
+            starts_repeat[1:] &= ~above[:-1]
+            repeats += starts_repeat.sum(axis=0)
+            prev_above = above[-1]
+
+            tile_best = averages.argmax(axis=0)
+            tile_scores = averages[tile_best, np.arange(num_times)]
+            improved = tile_scores > best
+            best[improved] = tile_scores[improved]
+            best_lag[improved] = lags[tile_best[improved]]
+
+        return repeats, best, best_lag
+
+    @staticmethod
+    def lowpass_filter(num_taps, cutoff):
+        """ design a linear phase (windowed sinc) low pass filter
+        :param num_taps: ``int`` the (odd) length of the filter
+        :param cutoff: ``float`` the cutoff frequency as a fraction of the sampling rate (0 to .5)
+        :return: float32 ``array`` of the filter's taps, which sum to 1
+        """
+        offsets = np.arange(num_taps) - (num_taps - 1) / 2.0
+        taps = np.sinc(2 * cutoff * offsets) * np.hamming(num_taps)
+        return (taps / taps.sum()).astype(np.float32)
+
+    @staticmethod
+    def decimation_factor(sample_rate, target_rate):
+        """
+        :return: ``int`` the largest factor which divides sample_rate and leaves it at or above target_rate (so the
+        reduced rate is still a whole number of samples per second), 1 if there is none
+        """
+        if not target_rate or target_rate >= sample_rate:
+            return 1
+        return max(factor for factor in range(1, sample_rate // target_rate + 1) if sample_rate % factor == 0)
+
+    @classmethod
+    def fourier_transform(cls, samples, sample_rate):
         """ create a Fourier Transform to analyze the data in the frequency domain
         (borrowed heavily from http://samcarcagno.altervista.org/blog/basic-sound-processing-python/)
         :param samples: an array of samples to create an FFT over
         :return: an array of two-tuple where each two tuple represents a frequency bin and it's associated power level
         """
-        print "creating fourier transform over samples"
-        n = len(samples)
-        n_unique_pts = math.ceil((n + 1) / 2.0)
-
-        transform = fft(samples)
-        transform = transform[0:n_unique_pts]
-        transform = abs(transform)
-        transform = transform / float(n)
-        transform = transform ** 2
-
-        if n % 2 > 0:
-            # we've got odd number of points fft
-            transform[1:len(transform)] = transform[1:len(transform)] * 2
-        else:
-            # we've got even number of points fft
-            transform[1:len(transform) - 1] = transform[1:len(transform) - 1] * 2
+        logger.debug("creating fourier transform over %d samples", len(samples))
+        frequencies, powers = cls.stft(samples, sample_rate, n_fft=len(samples), window=None)
 
         # the frequency bins (in kiloherz)
-        frequencies = (np.arange(0, n_unique_pts, 1.0) * (sample_rate / n)) / 1000
+        frequencies = frequencies / 1000
         # the values of the frequencies (in db)
-        powers = 10 * np.log10(transform)
+        powers = 10 * np.log10(powers[0])
+
+        return list(zip(frequencies, powers))
+
+
+class Decimator(object):
+    """ reduces the sampling rate of a stream of samples by a whole factor. Each chunk is low pass filtered (so
+    frequencies above the new nyquist don't alias) and only every factor'th filtered sample is ever computed. The
+    filter is centered on each output sample, so the n'th output lines up with the n'th * factor input sample and times
+    are unchanged by decimation. The filter is applied in polyphase form: the input is split into factor phases (every
+    factor'th sample, starting at each offset) and each tap scales a contiguous run of its phase, so applying a tap
+    to a whole chunk is a single vectorized multiply-add
+    """
+
+    def __init__(self, factor):
+        """
+        :param factor: ``int`` the factor the sampling rate is reduced by
+        """
+        self.factor = factor
+        # the filter rolls off from 80% of the new nyquist, so it's all but closed by the new nyquist itself
+        self.taps = SoundUtils.lowpass_filter(SoundUtils.TAPS_PER_FACTOR * factor + 1, .4 / factor)
+        self.half_width = len(self.taps) // 2
+        # the number of rows of factor samples spanned by the filter
+        self._num_rows = -(-len(self.taps) // factor)
+
+        # the input samples still needed by later outputs, starting with the first sample of the next output's window
+        # (the stream is padded with silence before its first sample)
+        self._pending = np.zeros(self.half_width, dtype=np.float32)
+
+    def num_outputs(self, num_samples):
+        """
+        :return: ``int`` the number of samples a stream of num_samples is decimated to
+        """
+        return -(-num_samples // self.factor)
+
+    def feed(self, samples):
+        """
+        :param samples: ``array`` of the next samples of the stream
+        :return: float32 ``array`` of every decimated sample whose window is now complete
+        """
+        samples = np.concatenate((self._pending, np.asarray(samples, dtype=np.float32)))
+        num_outputs = max(0, (len(samples) - self._num_rows * self.factor) // self.factor + 1)
+        if num_outputs == 0:
+            self._pending = samples
+            return np.zeros(0, dtype=np.float32)
+
+        # output i is the dot product of the (symmetric) filter and samples[i * factor:i * factor + len(taps)], so tap j
+        # meets sample i * factor + j, which is sample i + j // factor of phase j % factor
+        phases = samples[:(num_outputs + self._num_rows - 1) * self.factor].reshape(-1, self.factor).T.copy()
+        decimated = np.zeros(num_outputs, dtype=np.float32)
+        for j, tap in enumerate(self.taps):
+            decimated += tap * phases[j % self.factor, j // self.factor:j // self.factor + num_outputs]
+
+        self._pending = samples[num_outputs * self.factor:]
+        return decimated
+
+    def flush(self):
+        """ finish the stream (padding it with silence)
+        :return: float32 ``array`` of the remaining decimated samples
+        """
+        # enough silence to complete the padded window of the output at the last input sample, and no more
+        decimated = self.feed(np.zeros(self._num_rows * self.factor - self.half_width - 1, dtype=np.float32))
+        self._pending = np.zeros(self.half_width, dtype=np.float32)
+        return decimated
+
+    def decimate(self, chunks):
+        """
+        :param chunks: iterable of ``array`` of samples
+        :return: generator of float32 ``array`` of decimated samples
+        """
+        for chunk in chunks:
+            decimated = self.feed(chunk)
+            if len(decimated):
+                yield decimated
 
-        return zip(frequencies, powers)
\ No newline at end of file
+        decimated = self.flush()
+        if len(decimated):
+            yield decimated
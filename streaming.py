@@ -0,0 +1,187 @@
+from file_utils import FileUtils
+from models import Song
+import collections
+import heapq
+import numpy as np
+
+
+class Segment(object):
+    """ a candidate chorus found by a ``StreamingAnalyzer`` """
+    __slots__ = ("start", "end", "score", "average_amplitude")
+
+    def __init__(self, start=None, end=None, score=None, average_amplitude=None):
+        """
+        :param start: ``float`` the offset (in seconds) of the start of the segment
+        :param end: ``float`` the offset (in seconds) of the end of the segment
+        :param score: ``float`` how far (in standard deviations) the segment's amplitude was above the average at the
+        time it ended
+        :param average_amplitude: ``float``
+        """
+        self.start = start
+        self.end = end
+        self.score = score
+        self.average_amplitude = average_amplitude
+
+    def __lt__(self, other):
+        return self.score < other.score
+
+    def __repr__(self):
+        return "{start} - {end} ({score})".format(start=self.start, end=self.end, score=self.score)
+
+
+class StreamingAnalyzer(object):
+    """ an online version of Song's amplitude analysis for recordings too long to hold in memory (or which never end).
+    Samples are fed in a chunk at a time and are dropped as soon as they've been reduced to frame amplitudes. The
+    running mean / variance of the amplitudes (for the loud / quiet thresholds) are updated incrementally, and
+    sustained loud blocks are tracked as they happen. Memory use depends on the window and the number of candidates
+    kept, not on the length of the recording. Since the thresholds are only ever based on the audio heard so far, a
+    block is judged against the song up to the point it ended """
+    # the number of (not necessarily consecutive) frames which may dip below the loud threshold before a block ends
+    INCONGRUITY_CUSHION = 2
+
+    def __init__(self, sample_rate, window_seconds=600, min_chorus_length=10, max_chorus_length=60, num_candidates=5):
+        """
+        :param sample_rate: ``int`` the sampling rate of the audio (one frame is a second of audio)
+        :param window_seconds: ``int`` the number of seconds of the amplitude envelope kept (the most recent ones)
+        :param min_chorus_length: ``int`` the minimum number of loud frames in a candidate
+        :param max_chorus_length: ``int`` the maximum number of frames in a candidate (longer blocks are split)
+        :param num_candidates: ``int`` the number of (best scoring) candidates kept
+        """
+        self.sample_rate = sample_rate
+        self.min_chorus_length = min_chorus_length
+        self.max_chorus_length = max_chorus_length
+        self.num_candidates = num_candidates
+
+        # samples which don't yet make up a full frame
+        self._pending = np.zeros(0)
+        self.num_frames = 0
+        self.envelope = collections.deque(maxlen=window_seconds)
+
+        # running statistics of the frame amplitudes
+        self.mean = 0.0
+        self._sum_of_squares = 0.0
+
+        # the block of loud frames in progress: its first frame, number of loud frames, total amplitude, the number of
+        # frames since it started which weren't loud and its last loud frame
+        self._block = None
+        self._candidates = []
+
+    #####-----< Properties >-----#####
+    @property
+    def std(self):
+        return np.sqrt(self._sum_of_squares / self.num_frames) if self.num_frames else 0.0
+
+    @property
+    def quiet_threshold(self):
+        """ defines the amplitude threshold for what is considered "quiet" (everything below the returned value) """
+        return self.mean - (self.std * Song.SD_FOR_QUIET)
+
+    @property
+    def loud_threshold(self):
+        """ defines the amplitude threshold for what is considered "loud" (everything above the returned value) """
+        return self.mean + (self.std * Song.SD_FOR_LOUD)
+
+    @property
+    def candidates(self):
+        """
+        :return: ``list`` of the best ``Segment`` found so far, best first
+        """
+        return sorted(self._candidates, reverse=True)
+
+    #####-----< Helpers >-----#####
+    def _update_statistics(self, amplitudes):
+        """ merge the statistics of a batch of amplitudes into the running ones (Chan et al.'s parallel variance) """
+        count = self.num_frames + len(amplitudes)
+        batch_mean = amplitudes.mean()
+        delta = batch_mean - self.mean
+
+        self._sum_of_squares += ((amplitudes - batch_mean) ** 2).sum() + \
+            delta ** 2 * self.num_frames * len(amplitudes) / count
+        self.mean += delta * len(amplitudes) / count
+        self.num_frames = count
+
+    def _close_block(self):
+        """ end the block in progress, keeping it as a candidate if it was sustained """
+        first_frame, num_loud, total, _, last_frame = self._block
+        self._block = None
+
+        if num_loud < self.min_chorus_length:
+            return
+
+        average_amplitude = total / num_loud
+        segment = Segment(start=first_frame, end=last_frame + 1,
+                          score=(average_amplitude - self.mean) / self.std if self.std else 0.0,
+                          average_amplitude=average_amplitude)
+
+        if len(self._candidates) < self.num_candidates:
+            heapq.heappush(self._candidates, segment)
+        elif segment.score > self._candidates[0].score:
+            heapq.heapreplace(self._candidates, segment)
+
+    def _track_blocks(self, amplitudes, first_frame):
+        """ advance the block in progress over a batch of frame amplitudes """
+        loud_threshold = self.loud_threshold
+
+        for i, amplitude in enumerate(amplitudes):
+            frame = first_frame + i
+            loud = amplitude >= loud_threshold
+
+            if self._block is None:
+                if loud:
+                    self._block = [frame, 1, amplitude, 0, frame]
+                continue
+
+            if loud:
+                self._block[1] += 1
+                self._block[2] += amplitude
+                self._block[4] = frame
+            else:
+                self._block[3] += 1
+
+            if self._block[3] > self.INCONGRUITY_CUSHION or frame - self._block[0] + 1 >= self.max_chorus_length:
+                self._close_block()
+
+    #####-----< Public >-----#####
+    def feed(self, samples):
+        """ analyse the next chunk of samples. Only samples which don't yet make up a whole frame are kept """
+        samples = np.concatenate((self._pending, np.asarray(samples, dtype=np.float64)))
+        num_frames = len(samples) // self.sample_rate
+        self._pending = samples[num_frames * self.sample_rate:]
+
+        if num_frames == 0:
+            return
+
+        amplitudes = np.abs(samples[:num_frames * self.sample_rate]).reshape(num_frames, self.sample_rate).mean(axis=1)
+        first_frame = self.num_frames
+
+        self._update_statistics(amplitudes)
+        self.envelope.extend(amplitudes)
+        self._track_blocks(amplitudes, first_frame)
+
+    def finish(self):
+        """ close the block in progress (if any), e.g. once a recording has ended """
+        if self._block is not None:
+            self._close_block()
+
+    def analyze(self, chunks):
+        """ feed every chunk to the analyzer
+        :param chunks: iterable of ``array`` of samples
+        :return: the best ``Segment`` found, or None
+        """
+        for chunk in chunks:
+            self.feed(chunk)
+        self.finish()
+
+        candidates = self.candidates
+        return candidates[0] if candidates else None
+
+
+def find_chorus_streaming(path, analysis_rate=None, **kwargs):
+    """ find the chorus of the file at path without loading the whole file into memory
+    :param analysis_rate: ``int`` the sampling rate the file is analysed at (see FileUtils)
+    :param kwargs: passed to ``StreamingAnalyzer``
+    :return: two-tuple of the start and end (in seconds) of the chorus, or (None, None)
+    """
+    sample_rate, chunks = FileUtils(path, analysis_rate=analysis_rate).stream_file_data()
+    best = StreamingAnalyzer(sample_rate, **kwargs).analyze(chunks)
+    return (best.start, best.end) if best else (None, None)